@@ -5,6 +5,33 @@ from uuid import uuid4
 import subprocess
 import os
 import time
+import json
+import urllib.error
+import urllib.request
+
+
+python_bin = '/usr/local/envs/py310/bin/python'
+SERVER_URL = 'http://127.0.0.1:8000/jobs'
+SERVER_START_TIMEOUT = 120
+
+
+# Start the resident job server once, so the models stay loaded between requests
+def start_server():
+    server_process = subprocess.Popen([python_bin, 'server.py', '--port', '8000'])
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        # A server that failed to start (port in use, import error) has already exited
+        if server_process.poll() is not None:
+            raise RuntimeError(f'Job server exited with code {server_process.returncode}')
+        try:
+            urllib.request.urlopen(SERVER_URL, timeout=5)
+        except urllib.error.HTTPError:
+            # The server answers GET with an error, which means it is ready
+            return server_process
+        except urllib.error.URLError:
+            time.sleep(1)
+    server_process.kill()
+    raise RuntimeError(f'Job server did not start within {SERVER_START_TIMEOUT} seconds')
 
 
 # Assume you have a processing function that receives image and video paths
@@ -48,11 +75,8 @@ def process_media(image_path, video_path):
     output_filename = f'output_{uuid4()}.mp4'
     output_path = os.path.join(OUTPUT_DIR, output_filename)
     
-    # Execute the run.py script synchronously
-    python_bin = '/usr/local/envs/py310/bin/python'
-    run_script = 'run.py'
-    cmd = [
-        python_bin, run_script,
+    # Submit the job to the resident server, it runs synchronously
+    job_args = [
         '--execution-provider', 'cuda',
         '--execution-threads', '4',
         '-s', src_image_path,
@@ -60,16 +84,20 @@ def process_media(image_path, video_path):
         '-o', output_path,
         '--frame-processor', 'face_swapper'
     ]
-    
+
     try:
         start_time = time.time()
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        request = urllib.request.Request(SERVER_URL, data=json.dumps({'args': job_args}).encode(), headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
         print(f"Processing took {time.time() - start_time} seconds")
 
-        
-        print(f'Completed: Output saved to {output_path}')
-    except subprocess.CalledProcessError as e:
-        print(f'Error during processing: {e.stderr}Stdout: {e.stdout}')
+        if result['status'] == 'succeed':
+            print(f'Completed: Output saved to {output_path}')
+        else:
+            print(f'Error during processing: job {result["status"]}')
+    except urllib.error.URLError as e:
+        print(f'Error during processing: {e}')
 
 
     return output_path
@@ -92,6 +120,7 @@ demo = gr.Interface(
 
 
 # Launch Gradio application
+server_process = start_server()
 print("启动 Gradio 应用...")
 demo.launch(share=True, server_port=7860, allowed_paths=["/kaggle/working/outputs"], debug=True)   # debug=True,便于定位问题！！
 print("Gradio 应用已启动，请等待公共链接显示。")
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
+import cv2
+import numpy
+
+import roop.globals
+import roop.metadata
+import roop.face_analyser
+import roop.predictor
+from roop import core
+from roop.processors.frame.core import get_frame_processors_modules
+from roop.profiler import start_profile, get_profile_report
+from roop.typing import Face, Frame
+from roop.utilities import run_ffmpeg
+
+NAME = 'ROOP.BENCHMARK'
+BENCHMARK_EMBEDDING = numpy.full(512, 1 / numpy.sqrt(512), dtype=numpy.float32)
+BENCHMARK_LANDMARKS = numpy.array([[0.3419, 0.4616], [0.6565, 0.4598], [0.5002, 0.6405], [0.3710, 0.8247], [0.6315, 0.8232]], dtype=numpy.float32)
+MODEL_LATENCY = 0.0
+
+
+def parse_args() -> Tuple[argparse.Namespace, List[str]]:
+    program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100), epilog='remaining options are passed to the pipeline, for example --frame-processor face_swapper face_enhancer')
+    program.add_argument('--resolution', help='resolution of the synthetic video', dest='resolution', default='1280x720')
+    program.add_argument('--frames', help='number of frames of the synthetic video', dest='frames', type=int, default=120)
+    program.add_argument('--faces', help='number of faces per frame', dest='faces', type=int, default=1)
+    program.add_argument('--model-latency', help='milliseconds every stand-in model call takes', dest='model_latency', type=float, default=0)
+    program.add_argument('--runs', help='number of measured runs', dest='runs', type=int, default=3)
+    program.add_argument('--warmup-runs', help='number of runs before the measurement', dest='warmup_runs', type=int, default=1)
+    program.add_argument('--report-path', help='write the report to a json file', dest='report_path')
+    program.add_argument('--baseline-path', help='fail if the throughput dropped below a previous report', dest='baseline_path')
+    program.add_argument('--tolerance', help='throughput drop in percent that is accepted against the baseline', dest='tolerance', type=float, default=10)
+    return program.parse_known_args()
+
+
+def run() -> None:
+    global MODEL_LATENCY
+
+    args, pipeline_args = parse_args()
+    resolution = tuple(map(int, args.resolution.split('x')))
+    MODEL_LATENCY = args.model_latency / 1000
+    if not core.pre_check():
+        return
+    benchmark_directory_path = tempfile.mkdtemp(prefix='roop-benchmark-')
+    try:
+        source_path, target_path, output_path = create_benchmark_media(benchmark_directory_path, resolution, args.frames)
+        core.parse_args(['-s', source_path, '-t', target_path, '-o', output_path] + pipeline_args)
+        if roop.globals.execution_backend == 'process':
+            core.update_status('The stand-in models do not reach the workers of the process backend.', NAME)
+            sys.exit(1)
+        roop.globals.keep_models = True
+        # profiling is switched on by its path, the report is collected in memory
+        roop.globals.profile_path = os.path.join(benchmark_directory_path, 'profile.json')
+        roop.face_analyser.SOURCE_FACES_DIRECTORY = benchmark_directory_path
+        set_benchmark_models(args.faces)
+        for _ in range(args.warmup_runs):
+            run_benchmark(output_path)
+        benchmark_runs = [run_benchmark(output_path) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(benchmark_directory_path, ignore_errors=True)
+    report = get_benchmark_report(args, pipeline_args, benchmark_runs)
+    print_benchmark_report(report)
+    if args.report_path:
+        with open(args.report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+    if args.baseline_path and not check_benchmark_baseline(report, args.baseline_path, args.tolerance):
+        sys.exit(1)
+
+
+def create_benchmark_media(benchmark_directory_path: str, resolution: Tuple[int, ...], frames: int) -> Tuple[str, str, str]:
+    source_path = os.path.join(benchmark_directory_path, 'source.png')
+    target_path = os.path.join(benchmark_directory_path, 'target.mp4')
+    output_path = os.path.join(benchmark_directory_path, 'output.mp4')
+    width, height = resolution
+    # a fixed seed and test pattern keep the encoded media identical between runs and versions
+    cv2.imwrite(source_path, numpy.random.default_rng(0).integers(0, 256, (512, 512, 3), dtype=numpy.uint8))
+    if not run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30', '-f', 'lavfi', '-i', 'sine=frequency=440', '-frames:v', str(frames), '-shortest', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-y', target_path]):
+        core.update_status('Creating the synthetic video failed.', NAME)
+        sys.exit(1)
+    return source_path, target_path, output_path
+
+
+def set_benchmark_models(faces: int) -> None:
+    roop.face_analyser.FACE_ANALYSER = SimpleNamespace(
+        det_model=SimpleNamespace(detect=lambda frame, max_num, metric: detect_benchmark_faces(frame, faces)),
+        models={'detection': None, 'recognition': SimpleNamespace(get=recognize_benchmark_face)}
+    )
+    roop.predictor.OPENNSFW2 = SimpleNamespace(
+        Preprocessing=SimpleNamespace(YAHOO='YAHOO'),
+        preprocess_image=lambda image, preprocessing: numpy.asarray(image.resize((224, 224)), dtype=numpy.float32)
+    )
+    roop.predictor.PREDICTOR = SimpleNamespace(predict=lambda views: numpy.zeros((len(views), 2), dtype=numpy.float32))
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        if frame_processor.NAME == 'ROOP.FACE-SWAPPER':
+            setattr(frame_processor, 'FACE_SWAPPER', SimpleNamespace(
+                input_size=(128, 128),
+                input_mean=0.0,
+                input_std=255.0,
+                emap=numpy.eye(512, dtype=numpy.float32),
+                input_names=['target', 'source'],
+                output_names=['output'],
+                session=SimpleNamespace(get_inputs=lambda: [SimpleNamespace(shape=[1, 3, 128, 128])], run=swap_benchmark_faces)
+            ))
+        if frame_processor.NAME == 'ROOP.FACE-ENHANCER':
+            setattr(frame_processor, 'FACE_ENHANCER', SimpleNamespace(gfpgan=enhance_benchmark_faces, device='cpu'))
+
+
+def detect_benchmark_faces(frame: Frame, faces: int) -> Tuple[Any, Any]:
+    wait_benchmark_model()
+    height, width = frame.shape[:2]
+    face_size = min(height / 2, width / (faces + 1))
+    bounding_boxes = []
+    kpss = []
+    for index in range(faces):
+        left = (index + 0.5) * width / faces - face_size / 2
+        top = (height - face_size) / 2
+        bounding_boxes.append([left, top, left + face_size, top + face_size, 0.9])
+        kpss.append(BENCHMARK_LANDMARKS * face_size + [left, top])
+    return numpy.array(bounding_boxes, dtype=numpy.float32).reshape(-1, 5), numpy.array(kpss, dtype=numpy.float32).reshape(-1, 5, 2)
+
+
+def recognize_benchmark_face(frame: Frame, face: Face) -> None:
+    wait_benchmark_model()
+    face.embedding = BENCHMARK_EMBEDDING
+
+
+def swap_benchmark_faces(output_names: List[str], inputs: Dict[str, Any]) -> List[Any]:
+    wait_benchmark_model()
+    return [inputs['target'].copy()]
+
+
+def enhance_benchmark_faces(crop_tensor: Any, return_rgb: bool, weight: float) -> Tuple[Any]:
+    wait_benchmark_model()
+    return crop_tensor.clone(),
+
+
+def wait_benchmark_model() -> None:
+    # sleeping releases the gil like the inference of the real models does
+    if MODEL_LATENCY:
+        time.sleep(MODEL_LATENCY)
+
+
+def run_benchmark(output_path: str) -> Dict[str, Any]:
+    if os.path.isfile(output_path):
+        os.remove(output_path)
+    start_profile()
+    core.start()
+    profile_report = get_profile_report()
+    capture = cv2.VideoCapture(output_path)
+    frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    if not frame_total:
+        core.update_status('Processing the synthetic video failed.', NAME)
+        sys.exit(1)
+    return {
+        'wall_time': profile_report['wall_time'],
+        'frames': frame_total,
+        'frames_per_second': frame_total / profile_report['wall_time'],
+        'peak_memory': profile_report['peak_memory'],
+        'stages': profile_report['stages']
+    }
+
+
+def get_benchmark_report(args: argparse.Namespace, pipeline_args: List[str], benchmark_runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # the stages of the median run belong together, a median per stage would mix up the runs
+    median_run = sorted(benchmark_runs, key=lambda benchmark_run: benchmark_run['wall_time'])[len(benchmark_runs) // 2]
+    return {
+        'version': roop.metadata.version,
+        'settings': {
+            'resolution': args.resolution,
+            'frames': args.frames,
+            'faces': args.faces,
+            'model_latency': args.model_latency,
+            'pipeline_args': pipeline_args
+        },
+        'execution_providers': roop.globals.execution_providers,
+        'execution_threads': roop.globals.execution_threads,
+        'frames_per_second': statistics.median(benchmark_run['frames_per_second'] for benchmark_run in benchmark_runs),
+        'wall_time': median_run['wall_time'],
+        'peak_memory': max(benchmark_run['peak_memory'] for benchmark_run in benchmark_runs),
+        'stages': median_run['stages'],
+        'runs': benchmark_runs
+    }
+
+
+def print_benchmark_report(report: Dict[str, Any]) -> None:
+    core.update_status(f"{report['settings']['frames']} frames at {report['settings']['resolution']} with {report['frames_per_second']:.2f} frames per second", NAME)
+    core.update_status(f"{report['wall_time']:.3f}s wall time and {report['peak_memory'] / 1024 ** 2:.0f} MB peak memory", NAME)
+    for stage, profile_stage in sorted(report['stages'].items(), key=lambda item: item[1]['time'], reverse=True):
+        core.update_status(f"{stage:<12} {profile_stage['calls']:>8} calls {profile_stage['time']:>10.3f}s {profile_stage['mean_time'] * 1000:>10.3f}ms", NAME)
+
+
+def check_benchmark_baseline(report: Dict[str, Any], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path) as baseline_file:
+        baseline_report = json.load(baseline_file)
+    if baseline_report['settings'] != report['settings']:
+        core.update_status('Baseline was recorded with other settings.', NAME)
+        return False
+    throughput_change = (report['frames_per_second'] / baseline_report['frames_per_second'] - 1) * 100
+    if throughput_change < -tolerance:
+        core.update_status(f"Throughput dropped by {-throughput_change:.1f}% against {baseline_report['version']}.", NAME)
+        return False
+    core.update_status(f"Throughput changed by {throughput_change:+.1f}% against {baseline_report['version']}.", NAME)
+    return True
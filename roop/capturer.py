@@ -1,22 +1,97 @@
-from typing import Optional
+import os
+import threading
+import subprocess
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple
 import cv2
 
 from roop.typing import Frame
 
+VIDEO_CAPTURES: List[Dict[str, Any]] = []
+VIDEO_CAPTURES_LIMIT = 4
+VIDEO_KEYFRAMES: Dict[Tuple[str, float], List[int]] = {}
+VIDEO_FORWARD_LIMIT = 30
+THREAD_LOCK = threading.Lock()
+
 
 def get_video_frame(video_path: str, frame_number: int = 0) -> Optional[Frame]:
-    capture = cv2.VideoCapture(video_path)
-    frame_total = capture.get(cv2.CAP_PROP_FRAME_COUNT)
-    capture.set(cv2.CAP_PROP_POS_FRAMES, min(frame_total, frame_number - 1))
-    has_frame, frame = capture.read()
-    capture.release()
+    video_capture = acquire_video_capture(video_path)
+    try:
+        frame_total = int(video_capture['capture'].get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_position = max(min(frame_total, frame_number - 1), 0)
+        if should_read_forward(video_path, video_capture['position'], frame_position):
+            for _ in range(frame_position - video_capture['position']):
+                video_capture['capture'].grab()
+        else:
+            video_capture['capture'].set(cv2.CAP_PROP_POS_FRAMES, frame_position)
+        has_frame, frame = video_capture['capture'].read()
+        video_capture['position'] = frame_position + 1 if has_frame else -1
+    finally:
+        release_video_capture(video_capture)
     if has_frame:
         return frame
     return None
 
 
 def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    video_capture = acquire_video_capture(video_path)
+    try:
+        return int(video_capture['capture'].get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        release_video_capture(video_capture)
+
+
+def acquire_video_capture(video_path: str) -> Dict[str, Any]:
+    video_mtime = os.path.getmtime(video_path) if os.path.isfile(video_path) else 0
+    with THREAD_LOCK:
+        for video_capture in reversed(VIDEO_CAPTURES):
+            if video_capture['path'] == video_path and video_capture['mtime'] == video_mtime:
+                # a capture is handed to one caller at a time
+                VIDEO_CAPTURES.remove(video_capture)
+                return video_capture
+    return {'path': video_path, 'mtime': video_mtime, 'capture': cv2.VideoCapture(video_path), 'position': 0}
+
+
+def release_video_capture(video_capture: Dict[str, Any]) -> None:
+    with THREAD_LOCK:
+        VIDEO_CAPTURES.append(video_capture)
+        while len(VIDEO_CAPTURES) > VIDEO_CAPTURES_LIMIT:
+            VIDEO_CAPTURES.pop(0)['capture'].release()
+
+
+def clear_video_captures() -> None:
+    with THREAD_LOCK:
+        while VIDEO_CAPTURES:
+            VIDEO_CAPTURES.pop()['capture'].release()
+
+
+def should_read_forward(video_path: str, position: int, frame_position: int) -> bool:
+    if position < 0 or frame_position < position:
+        return False
+    if frame_position == position:
+        return True
+    video_keyframes = get_video_keyframes(video_path)
+    if video_keyframes:
+        # seeking decodes from the keyframe before the frame, which only pays off past the position
+        keyframe_index = bisect_right(video_keyframes, frame_position)
+        return keyframe_index == 0 or video_keyframes[keyframe_index - 1] <= position
+    return frame_position - position <= VIDEO_FORWARD_LIMIT
+
+
+def get_video_keyframes(video_path: str) -> List[int]:
+    video_key = (video_path, os.path.getmtime(video_path))
+    with THREAD_LOCK:
+        if video_key in VIDEO_KEYFRAMES:
+            return VIDEO_KEYFRAMES[video_key]
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts,flags', '-of', 'csv=p=0', video_path]
+    video_keyframes = []
+    try:
+        packets = [packet.split(',') for packet in subprocess.check_output(command).decode().split()]
+        # packets come in decoding order, the frame numbers follow the presentation order
+        presentation_packets = sorted((int(packet[0]), 'K' in packet[1]) for packet in packets if len(packet) > 1 and packet[0].lstrip('-').isdigit())
+        video_keyframes = [frame_number for frame_number, (_, is_keyframe) in enumerate(presentation_packets) if is_keyframe]
+    except Exception:
+        pass
+    with THREAD_LOCK:
+        VIDEO_KEYFRAMES[video_key] = video_keyframes
+    return video_keyframes
@@ -8,30 +8,41 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+from typing import List, Optional, Tuple
 import platform
 import signal
 import shutil
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from itertools import count
+from pathlib import Path
 import onnxruntime
-import tensorflow
 import roop.globals
 import roop.metadata
-import roop.ui as ui
-from roop.predictor import predict_image, predict_video
-from roop.processors.frame.core import get_frame_processors_modules
-from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from roop.capturer import get_video_frame
+from roop.face_analyser import get_one_face, get_source_face
+from roop.face_reference import get_face_reference, set_face_reference
+from roop.journal import find_journal_entry, find_journal_entries, write_journal, clear_journal, get_pending_frame_paths, set_journal_stage, clear_journal_stage
+from roop.predictor import predict_image, predict_frame_paths, predict_stream
+from roop.processors.frame.core import get_frame_processors_modules, process_images, process_image_chain, process_stream, process_video_chain, group_similar_frames, reuse_similar_frames, get_reused_frame_total, clear_reused_frame_total
+from roop.profiler import start_profile, write_profile_report
+from roop.typing import Face, Frame
+from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path, resolve_media_paths, read_temp_frame, write_temp_frame, get_temp_output_path, get_temp_reference_frame_path, detect_resolution, open_frame_reader, extract_segment_frames, skip_segment_frames, find_temp_frame_paths, encode_temp_frames, concat_segment_videos, get_temp_segment_paths
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
 
+SEGMENT_ENCODE_LIMIT = 2
 
-def parse_args() -> None:
+
+def parse_args(argv: Optional[List[str]] = None) -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
     program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
+    program.add_argument('--batch-manifest', help='json file listing the source, target and output of each job', dest='batch_manifest')
     program.add_argument('--frame-processor', help='frame processors (choices: face_swapper, face_enhancer, ...)', dest='frame_processor', default=['face_swapper'], nargs='+')
     program.add_argument('--keep-fps', help='keep target fps', dest='keep_fps', action='store_true')
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true')
@@ -40,21 +51,33 @@ def parse_args() -> None:
     program.add_argument('--reference-face-position', help='position of the reference face', dest='reference_face_position', type=int, default=0)
     program.add_argument('--reference-frame-number', help='number of the reference frame', dest='reference_frame_number', type=int, default=0)
     program.add_argument('--similar-face-distance', help='face distance used for recognition', dest='similar_face_distance', type=float, default=0.85)
-    program.add_argument('--temp-frame-format', help='image format used for frame extraction', dest='temp_frame_format', default='png', choices=['jpg', 'png'])
+    program.add_argument('--face-analyser-profile', help='face analyser modules to load (lean: only what the frame processors need)', dest='face_analyser_profile', default='lean', choices=['lean', 'full'])
+    program.add_argument('--face-detector-size', help='size used for face detection', dest='face_detector_size', type=int, default=640)
+    program.add_argument('--face-detector-score', help='minimum score used for face detection', dest='face_detector_score', type=float, default=0.5)
+    program.add_argument('--face-tracking-interval', help='number of frames to track faces between detections', dest='face_tracking_interval', type=int, default=0)
+    program.add_argument('--chain-frame-processors', help='run all frame processors in a single pass per frame and share their face detections', dest='chain_frame_processors', action='store_true')
+    program.add_argument('--frame-reuse-threshold', help='maximum pixel difference to reuse the previous processed frame (0 disables)', dest='frame_reuse_threshold', type=int, default=0, choices=range(256), metavar='[0-255]')
+    program.add_argument('--resume', help='resume an interrupted job from its temporary resources', dest='resume', action='store_true')
+    program.add_argument('--video-pipeline', help='pipeline used for video processing', dest='video_pipeline', default='frames', choices=['frames', 'stream', 'segments'])
+    program.add_argument('--segment-duration', help='length of the video segments in seconds (segments pipeline)', dest='segment_duration', type=float, default=10)
+    program.add_argument('--temp-frame-format', help='image format used for frame extraction', dest='temp_frame_format', default='png', choices=['jpg', 'png', 'raw'])
     program.add_argument('--temp-frame-quality', help='image quality used for frame extraction', dest='temp_frame_quality', type=int, default=0, choices=range(101), metavar='[0-100]')
     program.add_argument('--output-video-encoder', help='encoder used for the output video', dest='output_video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9', 'h264_nvenc', 'hevc_nvenc'])
     program.add_argument('--output-video-quality', help='quality used for the output video', dest='output_video_quality', type=int, default=35, choices=range(101), metavar='[0-100]')
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int)
     program.add_argument('--execution-provider', help='available execution provider (choices: cpu, ...)', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-backend', help='run the execution threads as threads or processes', dest='execution_backend', default='thread', choices=['thread', 'process'])
+    program.add_argument('--profile-path', help='write a json report of the time spent per stage (thread backend)', dest='profile_path')
     program.add_argument('-v', '--version', action='version', version=f'{roop.metadata.name} {roop.metadata.version}')
 
-    args = program.parse_args()
+    args = program.parse_args(argv)
 
     roop.globals.source_path = args.source_path
     roop.globals.target_path = args.target_path
     roop.globals.output_path = normalize_output_path(roop.globals.source_path, roop.globals.target_path, args.output_path)
-    roop.globals.headless = roop.globals.source_path is not None and roop.globals.target_path is not None and roop.globals.output_path is not None
+    roop.globals.batch_manifest = args.batch_manifest
+    roop.globals.headless = roop.globals.batch_manifest is not None or roop.globals.source_path is not None and roop.globals.target_path is not None and roop.globals.output_path is not None
     roop.globals.frame_processors = args.frame_processor
     roop.globals.keep_fps = args.keep_fps
     roop.globals.keep_frames = args.keep_frames
@@ -63,6 +86,15 @@ def parse_args() -> None:
     roop.globals.reference_face_position = args.reference_face_position
     roop.globals.reference_frame_number = args.reference_frame_number
     roop.globals.similar_face_distance = args.similar_face_distance
+    roop.globals.face_analyser_modules = decode_face_analyser_modules(args.face_analyser_profile)
+    roop.globals.face_detector_size = args.face_detector_size
+    roop.globals.face_detector_score = args.face_detector_score
+    roop.globals.face_tracking_interval = args.face_tracking_interval
+    roop.globals.chain_frame_processors = args.chain_frame_processors
+    roop.globals.frame_reuse_threshold = args.frame_reuse_threshold
+    roop.globals.resume = args.resume
+    roop.globals.video_pipeline = args.video_pipeline
+    roop.globals.segment_duration = args.segment_duration
     roop.globals.temp_frame_format = args.temp_frame_format
     roop.globals.temp_frame_quality = args.temp_frame_quality
     roop.globals.output_video_encoder = args.output_video_encoder
@@ -70,6 +102,8 @@ def parse_args() -> None:
     roop.globals.max_memory = args.max_memory
     roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
     roop.globals.execution_threads = args.execution_threads
+    roop.globals.execution_backend = args.execution_backend
+    roop.globals.profile_path = args.profile_path
 
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
@@ -81,6 +115,16 @@ def decode_execution_providers(execution_providers: List[str]) -> List[str]:
             if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
 
 
+def decode_face_analyser_modules(face_analyser_profile: str) -> List[str]:
+    face_analyser_modules: List[str] = []
+    if face_analyser_profile == 'lean':
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+            if not hasattr(frame_processor, 'FACE_ANALYSER_MODULES'):
+                return []
+            face_analyser_modules.extend(module for module in frame_processor.FACE_ANALYSER_MODULES if module not in face_analyser_modules)
+    return face_analyser_modules
+
+
 def suggest_execution_providers() -> List[str]:
     return encode_execution_providers(onnxruntime.get_available_providers())
 
@@ -92,12 +136,6 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_virtual_device_configuration(gpu, [
-            tensorflow.config.experimental.VirtualDeviceConfiguration(memory_limit=1024)
-        ])
     # limit memory usage
     if roop.globals.max_memory:
         memory = roop.globals.max_memory * 1024 ** 3
@@ -125,10 +163,12 @@ def pre_check() -> bool:
 def update_status(message: str, scope: str = 'ROOP.CORE') -> None:
     print(f'[{scope}] {message}')
     if not roop.globals.headless:
+        import roop.ui as ui
+
         ui.update_status(message)
 
 
-def start() -> None:
+def start(batch: bool = False) -> None:
     for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
         if not frame_processor.pre_start():
             return
@@ -140,7 +180,8 @@ def start() -> None:
         # process frame
         for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
             update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_image(roop.globals.source_path, roop.globals.output_path, roop.globals.output_path)
+        process_image_chain(roop.globals.source_path, roop.globals.output_path, roop.globals.output_path)
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
             frame_processor.post_process()
         # validate image
         if is_image(roop.globals.target_path):
@@ -149,36 +190,87 @@ def start() -> None:
             update_status('Processing to image failed!')
         return
     # process image to videos
-    if predict_video(roop.globals.target_path):
-        destroy()
     update_status('Creating temporary resources...')
     create_temp(roop.globals.target_path)
-    # extract frames
-    if roop.globals.keep_fps:
-        fps = detect_fps(roop.globals.target_path)
-        update_status(f'Extracting frames with {fps} FPS...')
-        extract_frames(roop.globals.target_path, fps)
-    else:
-        update_status('Extracting frames with 30 FPS...')
-        extract_frames(roop.globals.target_path)
-    # process frame
-    temp_frame_paths = get_temp_frame_paths(roop.globals.target_path)
-    if temp_frame_paths:
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_video(roop.globals.source_path, temp_frame_paths)
-            frame_processor.post_process()
-    else:
-        update_status('Frames not found...')
-        return
-    # create video
-    if roop.globals.keep_fps:
-        fps = detect_fps(roop.globals.target_path)
-        update_status(f'Creating video with {fps} FPS...')
-        create_video(roop.globals.target_path, fps)
+    if not roop.globals.resume:
+        clear_journal(roop.globals.target_path)
+    # stream frames
+    if roop.globals.video_pipeline == 'stream':
+        if roop.globals.keep_fps:
+            fps = detect_fps(roop.globals.target_path)
+            update_status(f'Streaming video with {fps} FPS...')
+        else:
+            fps = 30
+            update_status('Streaming video with 30 FPS...')
+        if not stream_video(fps, batch):
+            update_status('Streaming video failed!')
+            return
+    # process segments
+    elif roop.globals.video_pipeline == 'segments':
+        if roop.globals.keep_fps:
+            fps = detect_fps(roop.globals.target_path)
+            update_status(f'Processing segments with {fps} FPS...')
+        else:
+            fps = 30
+            update_status('Processing segments with 30 FPS...')
+        if not segment_video(fps, batch):
+            update_status('Processing segments failed!')
+            return
     else:
-        update_status('Creating video with 30 FPS...')
-        create_video(roop.globals.target_path)
+        # extract frames
+        extract_journal_entry = find_journal_entry(roop.globals.target_path, 'extract')
+        if extract_journal_entry:
+            update_status('Resuming with extracted frames...')
+            similar_frame_groups = extract_journal_entry['similar_frame_groups']
+        else:
+            if roop.globals.keep_fps:
+                fps = detect_fps(roop.globals.target_path)
+                update_status(f'Extracting frames with {fps} FPS...')
+                extract_frames(roop.globals.target_path, fps)
+            else:
+                update_status('Extracting frames with 30 FPS...')
+                extract_frames(roop.globals.target_path)
+            temp_frame_paths = get_temp_frame_paths(roop.globals.target_path)
+            if not temp_frame_paths:
+                update_status('Frames not found...')
+                return
+            if predict_frame_paths(temp_frame_paths):
+                reject_target(batch)
+                return
+            # resumed jobs find the frames processed, so the reference frame is kept aside
+            write_temp_frame(get_temp_reference_frame_path(roop.globals.target_path), read_temp_frame(temp_frame_paths[roop.globals.reference_frame_number]))
+            similar_frame_groups = group_similar_frames(temp_frame_paths)
+            write_journal(roop.globals.target_path, {'stage': 'extract', 'similar_frame_groups': similar_frame_groups})
+        # process frame
+        reference_frame = read_temp_frame(get_temp_reference_frame_path(roop.globals.target_path))
+        if roop.globals.chain_frame_processors:
+            chain_video(list(similar_frame_groups), reference_frame)
+        else:
+            get_frame_processors_faces(reference_frame)
+            # each frame processor reads the frames back from disk, only chained runs share the face detections
+            for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+                update_status('Progressing...', frame_processor.NAME)
+                set_journal_stage(frame_processor.NAME)
+                frame_processor.process_video(roop.globals.source_path, get_pending_frame_paths(roop.globals.target_path, frame_processor.NAME, list(similar_frame_groups)))
+                clear_journal_stage()
+                frame_processor.post_process()
+        reuse_similar_frames(similar_frame_groups)
+        # create video
+        if find_journal_entry(roop.globals.target_path, 'encode') and os.path.isfile(get_temp_output_path(roop.globals.target_path)):
+            update_status('Resuming with created video...')
+        else:
+            if roop.globals.keep_fps:
+                fps = detect_fps(roop.globals.target_path)
+                update_status(f'Creating video with {fps} FPS...')
+                done = create_video(roop.globals.target_path, fps)
+            else:
+                update_status('Creating video with 30 FPS...')
+                done = create_video(roop.globals.target_path)
+            if done:
+                write_journal(roop.globals.target_path, {'stage': 'encode'})
+    if roop.globals.frame_reuse_threshold:
+        update_status(f'Reused {get_reused_frame_total()} similar frames...')
+        clear_reused_frame_total()
     # handle audio
     if roop.globals.skip_audio:
         move_temp(roop.globals.target_path, roop.globals.output_path)
@@ -199,8 +291,174 @@ def start() -> None:
         update_status('Processing to video failed!')
 
 
+def is_batch() -> bool:
+    return roop.globals.batch_manifest is not None or os.path.isdir(roop.globals.source_path) or os.path.isdir(roop.globals.target_path)
+
+
+def get_batch_jobs() -> List[Tuple[str, str, str]]:
+    batch_jobs = []
+    if roop.globals.batch_manifest:
+        with open(roop.globals.batch_manifest) as batch_manifest_file:
+            batch_paths = [(batch_job['source'], batch_job['target'], batch_job['output']) for batch_job in json.load(batch_manifest_file)]
+    else:
+        Path(roop.globals.output_path).mkdir(parents=True, exist_ok=True)
+        batch_paths = [(source_path, target_path, roop.globals.output_path) for source_path in resolve_media_paths(roop.globals.source_path) for target_path in resolve_media_paths(roop.globals.target_path)]
+    for source_path, target_path, output_path in batch_paths:
+        output_path = normalize_output_path(source_path, target_path, output_path)
+        if output_path:
+            batch_jobs.append((source_path, target_path, output_path))
+    return batch_jobs
+
+
+def start_batch() -> None:
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    image_jobs = []
+    # models stay loaded between the jobs of a batch
+    roop.globals.keep_models = True
+    for source_path, target_path, output_path in get_batch_jobs():
+        roop.globals.source_path = source_path
+        roop.globals.target_path = target_path
+        roop.globals.output_path = output_path
+        if not has_image_extension(target_path):
+            start(batch=True)
+        elif all(frame_processor.pre_start() for frame_processor in frame_processors):
+            if predict_image(target_path):
+                reject_target(batch=True)
+            else:
+                image_jobs.append((source_path, target_path, output_path))
+    # small image jobs run in parallel, the frame processors batch their inference across them
+    if image_jobs:
+        update_status(f'Processing {len(image_jobs)} images...')
+        process_images(image_jobs, process_image_job)
+        for frame_processor in frame_processors:
+            frame_processor.post_process()
+        update_status('Processing to images succeed!')
+
+
+def process_image_job(source_path: str, target_path: str, output_path: str) -> None:
+    shutil.copy2(target_path, output_path)
+    process_image_chain(source_path, output_path, output_path)
+
+
+def get_frame_processors_faces(reference_frame: Frame) -> Tuple[Optional[Face], Optional[Face]]:
+    source_face = get_source_face(roop.globals.source_path) if is_image(roop.globals.source_path) else None
+    reference_face = None
+    if not roop.globals.many_faces:
+        reference_face = get_face_reference()
+        if not reference_face:
+            reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
+            set_face_reference(reference_face)
+    return source_face, reference_face
+
+
+def chain_video(temp_frame_paths: List[str], reference_frame: Frame) -> None:
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    source_face, reference_face = get_frame_processors_faces(reference_frame)
+    journal_stage = '+'.join(frame_processor.NAME for frame_processor in frame_processors)
+    for frame_processor in frame_processors:
+        update_status('Progressing...', frame_processor.NAME)
+    set_journal_stage(journal_stage)
+    process_video_chain(source_face, reference_face, get_pending_frame_paths(roop.globals.target_path, journal_stage, temp_frame_paths))
+    clear_journal_stage()
+    for frame_processor in frame_processors:
+        frame_processor.post_process()
+
+
+def stream_video(fps: float, batch: bool) -> bool:
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    reference_frame = get_video_frame(roop.globals.target_path, roop.globals.reference_frame_number)
+    source_face, reference_face = get_frame_processors_faces(reference_frame)
+    for frame_processor in frame_processors:
+        update_status('Progressing...', frame_processor.NAME)
+    done = process_stream(source_face, reference_face, roop.globals.target_path, fps)
+    for frame_processor in frame_processors:
+        frame_processor.post_process()
+    if predict_stream():
+        reject_target(batch)
+        return False
+    return done
+
+
+def segment_video(fps: float, batch: bool) -> bool:
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+    reference_frame = get_video_frame(roop.globals.target_path, roop.globals.reference_frame_number)
+    source_face, reference_face = get_frame_processors_faces(reference_frame)
+    resolution = detect_resolution(roop.globals.target_path)
+    segment_frame_total = max(int(roop.globals.segment_duration * fps), 1)
+    done_segment_numbers = {journal_entry['number'] for journal_entry in find_journal_entries(roop.globals.target_path, 'segment') if journal_entry['frame_total'] == segment_frame_total}
+    segment_video_paths = []
+    futures: List[Future[bool]] = []
+    is_nsfw = False
+    reader = open_frame_reader(roop.globals.target_path, fps)
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENT_ENCODE_LIMIT) as executor:
+            for segment_number in count(1):
+                segment_directory_path, segment_video_path = get_temp_segment_paths(roop.globals.target_path, segment_number)
+                if segment_number in done_segment_numbers and os.path.isfile(segment_video_path):
+                    if not skip_segment_frames(reader, resolution, segment_frame_total):
+                        break
+                else:
+                    # encoding runs in the background, waiting for it caps the frames on disk at a few segments
+                    pending_futures = [future for future in futures if not future.done()]
+                    if len(pending_futures) >= SEGMENT_ENCODE_LIMIT:
+                        wait(pending_futures, return_when=FIRST_COMPLETED)
+                    if not extract_segment_frames(reader, resolution, segment_directory_path, segment_frame_total):
+                        shutil.rmtree(segment_directory_path, ignore_errors=True)
+                        break
+                    temp_frame_paths = find_temp_frame_paths(segment_directory_path)
+                    is_nsfw = predict_frame_paths(temp_frame_paths)
+                    if is_nsfw:
+                        reader.kill()
+                        break
+                    update_status(f'Progressing segment {segment_number}...')
+                    process_segment(source_face, reference_face, temp_frame_paths)
+                    futures.append(executor.submit(encode_segment, segment_directory_path, segment_video_path, segment_number, segment_frame_total, fps))
+                segment_video_paths.append(segment_video_path)
+    finally:
+        reader.stdout.close()
+    for frame_processor in frame_processors:
+        frame_processor.post_process()
+    # the pending encodes are done at this point, so the temporary resources can go
+    if is_nsfw:
+        reader.wait()
+        reject_target(batch)
+        return False
+    if reader.wait() != 0 or not all(future.result() for future in futures) or not segment_video_paths:
+        return False
+    update_status(f'Concatenating {len(segment_video_paths)} segments...')
+    return concat_segment_videos(roop.globals.target_path, segment_video_paths)
+
+
+def process_segment(source_face: Optional[Face], reference_face: Optional[Face], temp_frame_paths: List[str]) -> None:
+    similar_frame_groups = group_similar_frames(temp_frame_paths)
+    if roop.globals.chain_frame_processors:
+        process_video_chain(source_face, reference_face, list(similar_frame_groups))
+    else:
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+            frame_processor.process_video(roop.globals.source_path, list(similar_frame_groups))
+    reuse_similar_frames(similar_frame_groups)
+
+
+def encode_segment(segment_directory_path: str, segment_video_path: str, segment_number: int, segment_frame_total: int, fps: float) -> bool:
+    if not encode_temp_frames(segment_directory_path, segment_video_path, fps):
+        return False
+    write_journal(roop.globals.target_path, {'stage': 'segment', 'number': segment_number, 'frame_total': segment_frame_total})
+    if not roop.globals.keep_frames:
+        shutil.rmtree(segment_directory_path)
+    return True
+
+
+def reject_target(batch: bool) -> None:
+    # one nsfw target must not end the remaining jobs of a batch
+    if not batch:
+        destroy()
+    update_status(f'Skipping {roop.globals.target_path} as it contains nsfw content...')
+    if not has_image_extension(roop.globals.target_path):
+        clean_temp(roop.globals.target_path)
+
+
 def destroy() -> None:
-    if roop.globals.target_path:
+    if roop.globals.target_path and not roop.globals.resume:
         clean_temp(roop.globals.target_path)
     sys.exit()
 
@@ -214,7 +472,15 @@ def run() -> None:
             return
     limit_resources()
     if roop.globals.headless:
-        start()
+        start_profile()
+        if is_batch():
+            start_batch()
+        else:
+            start()
+        if roop.globals.profile_path:
+            write_profile_report(roop.globals.profile_path)
     else:
+        import roop.ui as ui
+
         window = ui.init(start, destroy)
         window.mainloop()
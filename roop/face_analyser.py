@@ -1,13 +1,31 @@
+import os
+import hashlib
+import tempfile
 import threading
-from typing import Any, Optional, List
-import insightface
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, List, Tuple
+import cv2
 import numpy
 
 import roop.globals
+from roop.profiler import profile_stage
 from roop.typing import Frame, Face
+from roop.utilities import resolve_relative_path
 
 FACE_ANALYSER = None
+FACE_ANALYSER_MODEL = 'buffalo_l'
+SOURCE_FACES: Dict[Tuple[str, float], Face] = {}
+SOURCE_FACES_DIRECTORY = resolve_relative_path('../cache/source_faces')
+FACES_CACHE: 'OrderedDict[int, Tuple[weakref.ref[Frame], List[Face]]]' = OrderedDict()
+FACES_CACHE_LIMIT = 256
+FACES_TRACK = threading.local()
+FACES_TRACK_ERROR = 1.5
 THREAD_LOCK = threading.Lock()
+FACES_CACHE_LOCK = threading.Lock()
+SOURCE_FACES_LOCK = threading.Lock()
 
 
 def get_face_analyser() -> Any:
@@ -15,17 +33,29 @@ def get_face_analyser() -> Any:
 
     with THREAD_LOCK:
         if FACE_ANALYSER is None:
-            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers)
-            FACE_ANALYSER.prepare(ctx_id=0)
+            import insightface
+
+            FACE_ANALYSER = insightface.app.FaceAnalysis(name=FACE_ANALYSER_MODEL, allowed_modules=roop.globals.face_analyser_modules or None, providers=roop.globals.execution_providers)
+            FACE_ANALYSER.prepare(ctx_id=0, det_thresh=roop.globals.face_detector_score, det_size=(roop.globals.face_detector_size, roop.globals.face_detector_size))
     return FACE_ANALYSER
 
 
+def get_face_analyser_signature() -> str:
+    return ':'.join([FACE_ANALYSER_MODEL, ','.join(roop.globals.face_analyser_modules), str(roop.globals.face_detector_size), str(roop.globals.face_detector_score)])
+
+
 def clear_face_analyser() -> Any:
     global FACE_ANALYSER
 
     FACE_ANALYSER = None
 
 
+def create_face(face_attributes: Dict[str, Any]) -> Face:
+    from insightface.app.common import Face as AnalyserFace
+
+    return AnalyserFace(face_attributes)
+
+
 def get_one_face(frame: Frame, position: int = 0) -> Optional[Face]:
     many_faces = get_many_faces(frame)
     if many_faces:
@@ -36,13 +66,167 @@ def get_one_face(frame: Frame, position: int = 0) -> Optional[Face]:
     return None
 
 
+def get_source_face(source_path: str) -> Optional[Face]:
+    source_key = (source_path, os.path.getmtime(source_path))
+    with SOURCE_FACES_LOCK:
+        if source_key not in SOURCE_FACES:
+            source_face = load_source_face(source_path)
+            if source_face is None:
+                return None
+            SOURCE_FACES[source_key] = source_face
+    return SOURCE_FACES[source_key]
+
+
+def load_source_face(source_path: str) -> Optional[Face]:
+    with open(source_path, 'rb') as source_file:
+        source_hash = hashlib.sha1(get_face_analyser_signature().encode() + source_file.read()).hexdigest()
+    source_face_path = os.path.join(SOURCE_FACES_DIRECTORY, source_hash + '.npz')
+    if os.path.isfile(source_face_path):
+        try:
+            with numpy.load(source_face_path) as source_face_file:
+                return create_face(dict(source_face_file))
+        except Exception:
+            # a broken file is recomputed and replaced below
+            pass
+    source_face = get_one_face(cv2.imread(source_path))
+    if source_face:
+        save_source_face(source_face_path, source_face)
+    return source_face
+
+
+def save_source_face(source_face_path: str, source_face: Face) -> None:
+    Path(SOURCE_FACES_DIRECTORY).mkdir(parents=True, exist_ok=True)
+    # the file is written aside and moved into place, so a killed or concurrent job never leaves a partial one
+    temp_file_descriptor, temp_file_path = tempfile.mkstemp(suffix='.npz', dir=SOURCE_FACES_DIRECTORY)
+    try:
+        with os.fdopen(temp_file_descriptor, 'wb') as temp_file:
+            numpy.savez(temp_file, **{key: value for key, value in source_face.items() if value is not None})
+        os.replace(temp_file_path, source_face_path)
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
+
+
 def get_many_faces(frame: Frame) -> Optional[List[Face]]:
+    many_faces = get_faces_cache(frame)
+    if many_faces is None:
+        if roop.globals.face_tracking_interval and getattr(FACES_TRACK, 'enabled', False):
+            many_faces = track_many_faces(frame)
+        else:
+            many_faces = detect_many_faces(frame)
+        if many_faces is None:
+            return None
+        set_faces_cache(frame, many_faces)
+    return many_faces
+
+
+def detect_many_faces(frame: Frame) -> Optional[List[Face]]:
     try:
-        return get_face_analyser().get(frame)
+        return detect_faces(frame)
     except ValueError:
         return None
 
 
+def detect_faces(frame: Frame) -> List[Face]:
+    face_analyser = get_face_analyser()
+    # mirrors FaceAnalysis.get, split up to profile detection and recognition
+    with profile_stage('detect'):
+        bounding_boxes, kpss = face_analyser.det_model.detect(frame, max_num=0, metric='default')
+    many_faces = []
+    with profile_stage('recognize'):
+        for index, bounding_box in enumerate(bounding_boxes):
+            face = create_face(dict(bbox=bounding_box[:4], kps=kpss[index] if kpss is not None else None, det_score=bounding_box[4]))
+            for task_name, model in face_analyser.models.items():
+                if task_name != 'detection':
+                    model.get(frame, face)
+            many_faces.append(face)
+    return many_faces
+
+
+def start_face_tracking() -> None:
+    # only consecutive frames of a video are tracked, unrelated images of the same size could pass the flow check
+    FACES_TRACK.__dict__.clear()
+    FACES_TRACK.enabled = True
+
+
+def stop_face_tracking() -> None:
+    FACES_TRACK.__dict__.clear()
+
+
+@contextmanager
+def track_faces() -> Iterator[None]:
+    start_face_tracking()
+    try:
+        yield
+    finally:
+        stop_face_tracking()
+
+
+def track_many_faces(frame: Frame) -> Optional[List[Face]]:
+    gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    previous_gray_frame = getattr(FACES_TRACK, 'gray_frame', None)
+    many_faces = None
+    if previous_gray_frame is not None and previous_gray_frame.shape == gray_frame.shape and FACES_TRACK.many_faces and FACES_TRACK.frame_count < roop.globals.face_tracking_interval:
+        many_faces = move_many_faces(previous_gray_frame, gray_frame, FACES_TRACK.many_faces)
+    if many_faces is None:
+        many_faces = detect_many_faces(frame)
+        FACES_TRACK.frame_count = 0
+    else:
+        FACES_TRACK.frame_count += 1
+    FACES_TRACK.gray_frame = gray_frame
+    FACES_TRACK.many_faces = many_faces
+    return many_faces
+
+
+def move_many_faces(previous_gray_frame: Frame, gray_frame: Frame, many_faces: List[Face]) -> Optional[List[Face]]:
+    previous_points = numpy.concatenate([face.kps for face in many_faces]).reshape(-1, 1, 2).astype(numpy.float32)
+    points, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray_frame, gray_frame, previous_points, None)
+    backward_points, backward_status, _ = cv2.calcOpticalFlowPyrLK(gray_frame, previous_gray_frame, points, None)
+    # points that do not flow back to their origin mean the track is lost
+    if not status.all() or not backward_status.all() or numpy.abs(backward_points - previous_points).max() > FACES_TRACK_ERROR:
+        return None
+    moved_faces = []
+    for index, face in enumerate(many_faces):
+        face_points = points[index * 5:index * 5 + 5].reshape(-1, 2)
+        affine_matrix, _ = cv2.estimateAffinePartial2D(face.kps, face_points)
+        if affine_matrix is None:
+            return None
+        moved_face = create_face(dict(face))
+        moved_face.kps = face_points
+        moved_face.bbox = move_points(face.bbox.reshape(2, 2), affine_matrix).reshape(-1)
+        if face.landmark_2d_106 is not None:
+            moved_face.landmark_2d_106 = move_points(face.landmark_2d_106, affine_matrix)
+        moved_faces.append(moved_face)
+    return moved_faces
+
+
+def move_points(points: Any, affine_matrix: Any) -> Any:
+    return cv2.transform(points.reshape(-1, 1, 2).astype(numpy.float32), affine_matrix).reshape(-1, 2)
+
+
+def get_faces_cache(frame: Frame) -> Optional[List[Face]]:
+    with FACES_CACHE_LOCK:
+        faces_cache = FACES_CACHE.get(id(frame))
+        # ids of released frames are reused, the weak reference tells them apart
+        if faces_cache and faces_cache[0]() is frame:
+            FACES_CACHE.move_to_end(id(frame))
+            return faces_cache[1]
+    return None
+
+
+def set_faces_cache(frame: Frame, many_faces: List[Face]) -> None:
+    with FACES_CACHE_LOCK:
+        FACES_CACHE[id(frame)] = (weakref.ref(frame), many_faces)
+        FACES_CACHE.move_to_end(id(frame))
+        while len(FACES_CACHE) > FACES_CACHE_LIMIT:
+            FACES_CACHE.popitem(last=False)
+
+
+def clear_faces_cache() -> None:
+    with FACES_CACHE_LOCK:
+        FACES_CACHE.clear()
+
+
 def find_similar_face(frame: Frame, reference_face: Face) -> Optional[Face]:
     many_faces = get_many_faces(frame)
     if many_faces:
@@ -4,6 +4,7 @@ source_path: Optional[str] = None
 target_path: Optional[str] = None
 output_path: Optional[str] = None
 headless: Optional[bool] = None
+batch_manifest: Optional[str] = None
 frame_processors: List[str] = []
 keep_fps: Optional[bool] = None
 keep_frames: Optional[bool] = None
@@ -12,6 +13,15 @@ many_faces: Optional[bool] = None
 reference_face_position: Optional[int] = None
 reference_frame_number: Optional[int] = None
 similar_face_distance: Optional[float] = None
+face_analyser_modules: List[str] = []
+face_detector_size: Optional[int] = None
+face_detector_score: Optional[float] = None
+face_tracking_interval: Optional[int] = None
+chain_frame_processors: Optional[bool] = None
+frame_reuse_threshold: Optional[int] = None
+resume: Optional[bool] = None
+video_pipeline: Optional[str] = None
+segment_duration: Optional[float] = None
 temp_frame_format: Optional[str] = None
 temp_frame_quality: Optional[int] = None
 output_video_encoder: Optional[str] = None
@@ -19,4 +29,7 @@ output_video_quality: Optional[int] = None
 max_memory: Optional[int] = None
 execution_providers: List[str] = []
 execution_threads: Optional[int] = None
+execution_backend: Optional[str] = None
+keep_models: Optional[bool] = None
+profile_path: Optional[str] = None
 log_level: str = 'error'
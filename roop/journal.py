@@ -0,0 +1,85 @@
+import os
+import json
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import roop.globals
+from roop.utilities import get_temp_directory_path
+
+JOURNAL_FILE = 'journal.jsonl'
+JOURNAL_STAGE: Optional[str] = None
+THREAD_LOCK = threading.Lock()
+
+
+def get_journal_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), JOURNAL_FILE)
+
+
+def read_journal(target_path: str) -> List[Dict[str, Any]]:
+    journal_entries = []
+    journal_path = get_journal_path(target_path)
+    if os.path.isfile(journal_path):
+        with open(journal_path) as journal_file:
+            for journal_line in journal_file:
+                try:
+                    journal_entries.append(json.loads(journal_line))
+                except ValueError:
+                    pass
+    return journal_entries
+
+
+def write_journal(target_path: str, journal_entry: Dict[str, Any]) -> None:
+    with THREAD_LOCK:
+        with open(get_journal_path(target_path), 'a') as journal_file:
+            # a leading line break isolates the entry from one torn by a killed job
+            journal_file.write('\n' + json.dumps(journal_entry))
+
+
+def clear_journal(target_path: str) -> None:
+    journal_path = get_journal_path(target_path)
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+
+
+def find_journal_entry(target_path: str, stage: str) -> Optional[Dict[str, Any]]:
+    journal_entries = find_journal_entries(target_path, stage)
+    if journal_entries:
+        return journal_entries[0]
+    return None
+
+
+def find_journal_entries(target_path: str, stage: str) -> List[Dict[str, Any]]:
+    return [journal_entry for journal_entry in read_journal(target_path) if journal_entry.get('stage') == stage]
+
+
+def get_pending_frame_paths(target_path: str, stage: str, temp_frame_paths: List[str]) -> List[str]:
+    done_frame_names = set()
+    for journal_entry in find_journal_entries(target_path, stage):
+        done_frame_names.update(journal_entry['frames'])
+    return [temp_frame_path for temp_frame_path in temp_frame_paths if os.path.basename(temp_frame_path) not in done_frame_names]
+
+
+def set_journal_stage(stage: str) -> None:
+    global JOURNAL_STAGE
+
+    JOURNAL_STAGE = stage
+
+
+def clear_journal_stage() -> None:
+    global JOURNAL_STAGE
+
+    JOURNAL_STAGE = None
+
+
+def create_journal_update(temp_frame_paths: List[str], update: Optional[Callable[[], None]]) -> Optional[Callable[[], None]]:
+    if JOURNAL_STAGE and roop.globals.target_path:
+        # frame processors call update once per written frame and in order, which pins down the frame to journal
+        return partial(journal_frame, roop.globals.target_path, JOURNAL_STAGE, iter(temp_frame_paths), update)
+    return update
+
+
+def journal_frame(target_path: str, stage: str, temp_frame_paths: Iterator[str], update: Optional[Callable[[], None]]) -> None:
+    write_journal(target_path, {'stage': stage, 'frames': [os.path.basename(next(temp_frame_paths))]})
+    if update:
+        update()
@@ -1,19 +1,45 @@
 import threading
+from typing import Any, List
+import cv2
 import numpy
-import opennsfw2
-from PIL import Image
-from keras import Model
 
+from roop.profiler import profile_stage
 from roop.typing import Frame
+from roop.utilities import read_temp_frame
 
+OPENNSFW2 = None
 PREDICTOR = None
 THREAD_LOCK = threading.Lock()
 MAX_PROBABILITY = 0.85
+FRAME_INTERVAL = 100
+BATCH_SIZE = 8
+STREAM_FRAMES: List[Frame] = []
+STREAM_FRAME_NUMBER = 0
+STREAM_PREDICTION = False
 
 
-def get_predictor() -> Model:
+def get_opennsfw2() -> Any:
+    global OPENNSFW2
+
+    with THREAD_LOCK:
+        if OPENNSFW2 is None:
+            import tensorflow
+
+            # prevent tensorflow memory leak
+            for gpu in tensorflow.config.experimental.list_physical_devices('GPU'):
+                tensorflow.config.experimental.set_virtual_device_configuration(gpu, [
+                    tensorflow.config.experimental.VirtualDeviceConfiguration(memory_limit=1024)
+                ])
+            import opennsfw2
+
+            OPENNSFW2 = opennsfw2
+    return OPENNSFW2
+
+
+def get_predictor() -> Any:
     global PREDICTOR
 
+    opennsfw2 = get_opennsfw2()
     with THREAD_LOCK:
         if PREDICTOR is None:
             PREDICTOR = opennsfw2.make_open_nsfw_model()
@@ -27,17 +53,48 @@ def clear_predictor() -> None:
 
 
 def predict_frame(target_frame: Frame) -> bool:
-    image = Image.fromarray(target_frame)
-    image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
-    views = numpy.expand_dims(image, axis=0)
-    _, probability = get_predictor().predict(views)[0]
-    return probability > MAX_PROBABILITY
+    return predict_frames([target_frame])
 
 
-def predict_image(target_path: str) -> bool:
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+def predict_frames(target_frames: List[Frame]) -> bool:
+    from PIL import Image
+
+    opennsfw2 = get_opennsfw2()
+    views = numpy.stack([opennsfw2.preprocess_image(Image.fromarray(cv2.cvtColor(target_frame, cv2.COLOR_BGR2RGB)), opennsfw2.Preprocessing.YAHOO) for target_frame in target_frames])
+    with profile_stage('predict'):
+        probabilities = get_predictor().predict(views)[:, 1]
+    return bool(numpy.any(probabilities > MAX_PROBABILITY))
+
 
+def predict_frame_paths(target_frame_paths: List[str]) -> bool:
+    sample_frame_paths = target_frame_paths[::FRAME_INTERVAL]
+    for index in range(0, len(sample_frame_paths), BATCH_SIZE):
+        if predict_frames([read_temp_frame(sample_frame_path) for sample_frame_path in sample_frame_paths[index:index + BATCH_SIZE]]):
+            return True
+    return False
 
-def predict_video(target_path: str) -> bool:
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
-    return any(probability > MAX_PROBABILITY for probability in probabilities)
+
+def predict_stream_frame(target_frame: Frame) -> bool:
+    global STREAM_FRAME_NUMBER, STREAM_PREDICTION
+
+    if not STREAM_PREDICTION and STREAM_FRAME_NUMBER % FRAME_INTERVAL == 0:
+        STREAM_FRAMES.append(target_frame.copy())
+        if len(STREAM_FRAMES) >= BATCH_SIZE:
+            STREAM_PREDICTION = predict_frames(STREAM_FRAMES)
+            STREAM_FRAMES.clear()
+    STREAM_FRAME_NUMBER += 1
+    return STREAM_PREDICTION
+
+
+def predict_stream() -> bool:
+    global STREAM_FRAME_NUMBER, STREAM_PREDICTION
+
+    stream_prediction = STREAM_PREDICTION or bool(STREAM_FRAMES) and predict_frames(STREAM_FRAMES)
+    STREAM_FRAMES.clear()
+    STREAM_FRAME_NUMBER = 0
+    STREAM_PREDICTION = False
+    return stream_prediction
+
+
+def predict_image(target_path: str) -> bool:
+    return predict_frame(cv2.imread(target_path))
@@ -1,25 +1,47 @@
 import os
 import sys
+import subprocess
+import copyreg
 import importlib
+import multiprocessing
+import threading
+import cv2
+import numpy
 import psutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, Future
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
 from queue import Queue
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Dict, Iterator, List, Callable, Deque, Optional, Tuple
 from tqdm import tqdm
 
 import roop
+from roop.capturer import get_video_frame_total
+from roop.face_analyser import create_face, get_one_face, get_source_face, track_faces
+from roop.face_reference import get_face_reference, set_face_reference
+from roop.journal import create_journal_update
+from roop.predictor import predict_stream_frame
+from roop.typing import Face, Frame
+from roop.utilities import is_image, detect_fps, detect_resolution, open_frame_reader, open_frame_writer, read_frame, write_frame, read_temp_frame, write_temp_frame, copy_temp_frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
     'process_frame',
+    'process_frame_batch',
     'process_frames',
     'process_image',
     'process_video',
     'post_process'
 ]
+QUEUE_PER_FUTURE_LIMIT = 16
+PROGRESS_BAR_FORMAT = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+SHARED_MEMORY: Dict[str, SharedMemory] = {}
+REUSED_FRAME_TOTAL = 0
+THUMBNAIL_SIZE = (64, 64)
 
 
 def load_frame_processor_module(frame_processor: str) -> Any:
@@ -45,16 +67,49 @@ def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType
     return FRAME_PROCESSORS_MODULES
 
 
+def clear_frame_processors_modules() -> None:
+    FRAME_PROCESSORS_MODULES.clear()
+
+
+def create_executor() -> Executor:
+    if roop.globals.execution_backend == 'process':
+        from insightface.app.common import Face as AnalyserFace
+
+        # insightface faces resolve unknown attributes to None and therefore break the default pickling
+        copyreg.pickle(AnalyserFace, lambda face: (create_face, (dict(face),)))
+        return ProcessPoolExecutor(max_workers=roop.globals.execution_threads, mp_context=multiprocessing.get_context('spawn'), initializer=init_process, initargs=(get_globals_state(), get_face_reference()))
+    return ThreadPoolExecutor(max_workers=roop.globals.execution_threads)
+
+
+def get_globals_state() -> Dict[str, Any]:
+    return {name: value for name, value in vars(roop.globals).items() if not name.startswith('_') and not callable(value) and not isinstance(value, ModuleType)}
+
+
+def init_process(globals_state: Dict[str, Any], reference_face: Face) -> None:
+    for name, value in globals_state.items():
+        setattr(roop.globals, name, value)
+    if reference_face:
+        set_face_reference(reference_face)
+
+
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], update: Callable[[], None]) -> None:
-    with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
-        futures = []
+    with create_executor() as executor:
+        futures = {}
         queue = create_queue(temp_frame_paths)
-        queue_per_future = max(len(temp_frame_paths) // roop.globals.execution_threads, 1)
+        # small batches of adjacent frames are picked up by whichever worker is idle
+        queue_per_future = min(max(len(temp_frame_paths) // (roop.globals.execution_threads * 4), 1), QUEUE_PER_FUTURE_LIMIT)
         while not queue.empty():
-            future = executor.submit(process_frames, source_path, pick_queue(queue, queue_per_future), update)
-            futures.append(future)
+            queue_frame_paths = pick_queue(queue, queue_per_future)
+            if isinstance(executor, ProcessPoolExecutor):
+                future = executor.submit(process_frames, source_path, queue_frame_paths, create_journal_update(queue_frame_paths, None))
+            else:
+                future = executor.submit(process_frames, source_path, queue_frame_paths, create_journal_update(queue_frame_paths, update))
+            futures[future] = len(queue_frame_paths)
         for future in as_completed(futures):
             future.result()
+            if isinstance(executor, ProcessPoolExecutor):
+                for _ in range(futures[future]):
+                    update()
 
 
 def create_queue(temp_frame_paths: List[str]) -> Queue[str]:
@@ -64,7 +119,7 @@ def create_queue(temp_frame_paths: List[str]) -> Queue[str]:
     return queue
 
 
-def pick_queue(queue: Queue[str], queue_per_future: int) -> List[str]:
+def pick_queue(queue: Queue[Any], queue_per_future: int) -> List[Any]:
     queues = []
     for _ in range(queue_per_future):
         if not queue.empty():
@@ -72,13 +127,265 @@ def pick_queue(queue: Queue[str], queue_per_future: int) -> List[str]:
     return queues
 
 
+def process_batch(batch_queue: Queue[Any], batch_lock: threading.Lock, batch_items: List[Any], process_items: Callable[[List[Any]], List[Any]], batch_size: int) -> List[Any]:
+    # callers pass the crops of all their frames at once, so batches fill up even with a single execution thread
+    futures: List[Future[Any]] = []
+    for batch_item in batch_items:
+        future: Future[Any] = Future()
+        batch_queue.put((batch_item, future))
+        futures.append(future)
+    # whoever holds the lock runs everything queued meanwhile by the waiting threads
+    while not all(future.done() for future in futures):
+        with batch_lock:
+            batch = pick_queue(batch_queue, batch_size)
+            if batch:
+                try:
+                    results = process_items([batch_item for batch_item, _ in batch])
+                    for (_, batch_future), result in zip(batch, results):
+                        batch_future.set_result(result)
+                except Exception as exception:
+                    for _, batch_future in batch:
+                        batch_future.set_exception(exception)
+    return [future.result() for future in futures]
+
+
+def get_paste_back_region(temp_frame: Frame, crop_frame: Frame, inverse_matrix: Any) -> Tuple[Tuple[slice, slice], Any]:
+    crop_height, crop_width = crop_frame.shape[:2]
+    crop_points = cv2.transform(numpy.array([[[0, 0], [crop_width, 0], [0, crop_height], [crop_width, crop_height]]], dtype=numpy.float32), inverse_matrix)[0]
+    (left, top), (right, bottom) = crop_points.min(axis=0), crop_points.max(axis=0)
+    # the soft masks spread by a twentieth of the face size at most, the padding keeps them from being cut off
+    padding = max(int(max(right - left, bottom - top)) // 20, 5) + 2
+    left = min(max(int(left) - padding, 0), temp_frame.shape[1])
+    top = min(max(int(top) - padding, 0), temp_frame.shape[0])
+    right = max(min(int(right) + padding + 1, temp_frame.shape[1]), left)
+    bottom = max(min(int(bottom) + padding + 1, temp_frame.shape[0]), top)
+    region_matrix = inverse_matrix.copy()
+    region_matrix[:, 2] -= (left, top)
+    return (slice(top, bottom), slice(left, right)), region_matrix
+
+
+def multi_process_stream(read: Callable[[], Optional[Frame]], write: Callable[[Frame], None], source_face: Face, reference_face: Face, update: Callable[[], None]) -> None:
+    with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
+        futures: Deque[Tuple[List[int], Future[List[Frame]]]] = deque()
+        for temp_frames, frame_indices in read_stream_runs(read):
+            futures.append((frame_indices, executor.submit(process_frame_run, source_face, reference_face, temp_frames)))
+            # keep the frame order while bounding the frames held in memory
+            if len(futures) >= roop.globals.execution_threads * 2:
+                frame_indices, future = futures.popleft()
+                write_stream_run(write, future.result(), frame_indices, update)
+        while futures:
+            frame_indices, future = futures.popleft()
+            write_stream_run(write, future.result(), frame_indices, update)
+
+
+def multi_process_shared_stream(read: Callable[[], Optional[Frame]], write: Callable[[Frame], None], resolution: Tuple[int, int], source_face: Face, reference_face: Face, update: Callable[[], None]) -> None:
+    width, height = resolution
+    slot_total = roop.globals.execution_threads * 2 * get_stream_run_length()
+    shared_memory = SharedMemory(create=True, size=slot_total * height * width * 3)
+    try:
+        shared_frames = numpy.ndarray((slot_total, height, width, 3), dtype=numpy.uint8, buffer=shared_memory.buf)
+        with create_executor() as executor:
+            futures: Deque[Tuple[List[int], List[int], Future[None]]] = deque()
+            frame_number = 0
+            for temp_frames, frame_indices in read_stream_runs(read):
+                # at most threads * 2 runs are in flight, so a slot is written again only once its run has been written out
+                slots = [(frame_number + index) % slot_total for index in range(len(temp_frames))]
+                frame_number += len(temp_frames)
+                for slot, temp_frame in zip(slots, temp_frames):
+                    shared_frames[slot] = temp_frame
+                futures.append((slots, frame_indices, executor.submit(process_shared_frames, shared_memory.name, shared_frames.shape, slots, source_face, reference_face)))
+                if len(futures) >= roop.globals.execution_threads * 2:
+                    slots, frame_indices, future = futures.popleft()
+                    future.result()
+                    write_stream_run(write, [shared_frames[slot] for slot in slots], frame_indices, update)
+            while futures:
+                slots, frame_indices, future = futures.popleft()
+                future.result()
+                write_stream_run(write, [shared_frames[slot] for slot in slots], frame_indices, update)
+        del shared_frames
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def process_shared_frames(shared_memory_name: str, shape: Tuple[int, ...], slots: List[int], source_face: Face, reference_face: Face) -> None:
+    if shared_memory_name not in SHARED_MEMORY:
+        SHARED_MEMORY[shared_memory_name] = SharedMemory(name=shared_memory_name)
+    shared_frames = numpy.ndarray(shape, dtype=numpy.uint8, buffer=SHARED_MEMORY[shared_memory_name].buf)
+    result_frames = process_frame_run(source_face, reference_face, [shared_frames[slot] for slot in slots])
+    for slot, result_frame in zip(slots, result_frames):
+        shared_frames[slot] = result_frame
+
+
+def get_stream_run_length() -> int:
+    # runs span the tracking interval, so faces are detected once per run and tracked through the rest of it
+    return min((roop.globals.face_tracking_interval or 0) + 1, QUEUE_PER_FUTURE_LIMIT)
+
+
+def read_stream_runs(read: Callable[[], Optional[Frame]]) -> Iterator[Tuple[List[Frame], List[int]]]:
+    temp_frames: List[Frame] = []
+    frame_indices: List[int] = []
+    similar_thumbnail = None
+    run_length = get_stream_run_length()
+    temp_frame = read()
+    while temp_frame is not None:
+        thumbnail = create_thumbnail(temp_frame) if roop.globals.frame_reuse_threshold else None
+        if is_similar_thumbnail(thumbnail, similar_thumbnail):
+            count_reused_frame()
+        else:
+            temp_frames.append(temp_frame)
+            similar_thumbnail = thumbnail
+        # every frame of the run points at the processed frame it is written as
+        frame_indices.append(len(temp_frames) - 1)
+        if len(frame_indices) == run_length:
+            yield temp_frames, frame_indices
+            temp_frames, frame_indices, similar_thumbnail = [], [], None
+        temp_frame = read()
+    if frame_indices:
+        yield temp_frames, frame_indices
+
+
+def process_frame_run(source_face: Face, reference_face: Face, temp_frames: List[Frame]) -> List[Frame]:
+    # a run holds consecutive frames of the stream, so a single worker tracks the faces across it
+    with track_faces():
+        return process_frame_batch_chain(source_face, reference_face, temp_frames)
+
+
+def write_stream_run(write: Callable[[Frame], None], result_frames: List[Frame], frame_indices: List[int], update: Callable[[], None]) -> None:
+    for frame_index in frame_indices:
+        write(result_frames[frame_index])
+        update()
+
+
+def create_thumbnail(temp_frame: Frame) -> Frame:
+    return cv2.resize(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2GRAY), THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(numpy.int16)
+
+
+def is_similar_thumbnail(thumbnail: Optional[Frame], similar_thumbnail: Optional[Frame]) -> bool:
+    if thumbnail is not None and similar_thumbnail is not None:
+        return bool(numpy.abs(thumbnail - similar_thumbnail).max() < roop.globals.frame_reuse_threshold)
+    return False
+
+
+def group_similar_frames(temp_frame_paths: List[str]) -> Dict[str, List[str]]:
+    similar_frame_groups: Dict[str, List[str]] = {}
+    if not roop.globals.frame_reuse_threshold:
+        return {temp_frame_path: [] for temp_frame_path in temp_frame_paths}
+    with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
+        thumbnails = executor.map(lambda temp_frame_path: create_thumbnail(read_temp_frame(temp_frame_path, cv2.IMREAD_REDUCED_COLOR_2)), temp_frame_paths)
+        similar_frame_path = None
+        similar_thumbnail = None
+        for temp_frame_path, thumbnail in zip(temp_frame_paths, thumbnails):
+            if is_similar_thumbnail(thumbnail, similar_thumbnail):
+                similar_frame_groups[similar_frame_path].append(temp_frame_path)
+                count_reused_frame()
+            else:
+                similar_frame_path = temp_frame_path
+                similar_frame_groups[similar_frame_path] = []
+                similar_thumbnail = thumbnail
+    return similar_frame_groups
+
+
+def reuse_similar_frames(similar_frame_groups: Dict[str, List[str]]) -> None:
+    for similar_frame_path, temp_frame_paths in similar_frame_groups.items():
+        for temp_frame_path in temp_frame_paths:
+            copy_temp_frame(similar_frame_path, temp_frame_path)
+
+
+def count_reused_frame() -> None:
+    global REUSED_FRAME_TOTAL
+
+    REUSED_FRAME_TOTAL += 1
+
+
+def get_reused_frame_total() -> int:
+    return REUSED_FRAME_TOTAL
+
+
+def clear_reused_frame_total() -> None:
+    global REUSED_FRAME_TOTAL
+
+    REUSED_FRAME_TOTAL = 0
+
+
+def process_frame_chain(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        temp_frame = frame_processor.process_frame(source_face, reference_face, temp_frame)
+    return temp_frame
+
+
+def process_frame_batch_chain(source_face: Face, reference_face: Face, temp_frames: List[Frame]) -> List[Frame]:
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        temp_frames = frame_processor.process_frame_batch(source_face, reference_face, temp_frames)
+    return temp_frames
+
+
+def process_frames_chain(source_face: Face, reference_face: Face, source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    with track_faces():
+        result_frames = process_frame_batch_chain(source_face, reference_face, temp_frames)
+    for temp_frame_path, result in zip(temp_frame_paths, result_frames):
+        write_temp_frame(temp_frame_path, result)
+        if update:
+            update()
+
+
+def process_image_chain(source_path: str, target_path: str, output_path: str) -> None:
+    target_frame = cv2.imread(target_path)
+    source_face = get_source_face(source_path) if is_image(source_path) else None
+    reference_face = None if roop.globals.many_faces else get_one_face(target_frame, roop.globals.reference_face_position)
+    # the frame stays in memory between the frame processors, so they share its face detections
+    cv2.imwrite(output_path, process_frame_chain(source_face, reference_face, target_frame))
+
+
 def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
-    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(frame_paths)
-    with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+    with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=PROGRESS_BAR_FORMAT) as progress:
         multi_process_frame(source_path, frame_paths, process_frames, lambda: update_progress(progress))
 
 
+def process_images(image_jobs: List[Tuple[str, str, str]], process_image: Callable[[str, str, str], None]) -> None:
+    with tqdm(total=len(image_jobs), desc='Processing', unit='image', dynamic_ncols=True, bar_format=PROGRESS_BAR_FORMAT) as progress:
+        with create_executor() as executor:
+            futures = [executor.submit(process_image, *image_job) for image_job in image_jobs]
+            for future in as_completed(futures):
+                future.result()
+                update_progress(progress)
+
+
+def process_video_chain(source_face: Face, reference_face: Face, frame_paths: List[str]) -> None:
+    process_video(None, frame_paths, partial(process_frames_chain, source_face, reference_face))
+
+
+def process_stream(source_face: Face, reference_face: Face, target_path: str, fps: float) -> bool:
+    resolution = detect_resolution(target_path)
+    total = int(get_video_frame_total(target_path) * fps / detect_fps(target_path))
+    reader = open_frame_reader(target_path, fps)
+    writer = open_frame_writer(target_path, resolution, fps)
+    try:
+        with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=PROGRESS_BAR_FORMAT) as progress:
+            if roop.globals.execution_backend == 'process':
+                multi_process_shared_stream(lambda: read_stream_frame(reader, resolution), lambda temp_frame: write_frame(writer, temp_frame), resolution, source_face, reference_face, lambda: update_progress(progress))
+            else:
+                multi_process_stream(lambda: read_stream_frame(reader, resolution), lambda temp_frame: write_frame(writer, temp_frame), source_face, reference_face, lambda: update_progress(progress))
+    except BrokenPipeError:
+        reader.kill()
+        writer.kill()
+    finally:
+        writer.stdin.close()
+        reader.stdout.close()
+    return reader.wait() == 0 and writer.wait() == 0
+
+
+def read_stream_frame(reader: 'subprocess.Popen[bytes]', resolution: Tuple[int, int]) -> Optional[Frame]:
+    temp_frame = read_frame(reader, resolution)
+    # the screening samples the decoded stream and ends it on the first hit
+    if temp_frame is not None and predict_stream_frame(temp_frame):
+        reader.kill()
+        return None
+    return temp_frame
+
+
 def update_progress(progress: Any = None) -> None:
     process = psutil.Process(os.getpid())
     memory_usage = process.memory_info().rss / 1024 / 1024 / 1024
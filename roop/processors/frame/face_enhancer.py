@@ -1,19 +1,28 @@
 from typing import Any, List, Callable
+from queue import Queue
 import cv2
+import numpy
 import threading
+import torch
 from gfpgan.utils import GFPGANer
 
 import roop.globals
 import roop.processors.frame.core
 from roop.core import update_status
-from roop.face_analyser import get_many_faces
+from roop.face_analyser import get_many_faces, track_faces
+from roop.profiler import profile_stage
 from roop.typing import Frame, Face
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, read_temp_frame, write_temp_frame
 
 FACE_ENHANCER = None
-THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
+BATCH_QUEUE: Queue[Any] = Queue()
+BATCH_LOCK = threading.Lock()
+BATCH_SIZE = 8
+FFHQ_TEMPLATE = numpy.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935], [201.26117, 371.41043], [313.08905, 371.15118]], dtype=numpy.float32)
+FFHQ_SIZE = 512
 NAME = 'ROOP.FACE-ENHANCER'
+FACE_ANALYSER_MODULES = ['detection']
 
 
 def get_face_enhancer() -> Any:
@@ -55,41 +64,66 @@ def pre_start() -> bool:
 
 
 def post_process() -> None:
-    clear_face_enhancer()
-
-
-def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
-    start_x, start_y, end_x, end_y = map(int, target_face['bbox'])
-    padding_x = int((end_x - start_x) * 0.5)
-    padding_y = int((end_y - start_y) * 0.5)
-    start_x = max(0, start_x - padding_x)
-    start_y = max(0, start_y - padding_y)
-    end_x = max(0, end_x + padding_x)
-    end_y = max(0, end_y + padding_y)
-    temp_face = temp_frame[start_y:end_y, start_x:end_x]
-    if temp_face.size:
-        with THREAD_SEMAPHORE:
-            _, _, temp_face = get_face_enhancer().enhance(
-                temp_face,
-                paste_back=True
-            )
-        temp_frame[start_y:end_y, start_x:end_x] = temp_face
-    return temp_frame
+    if not roop.globals.keep_models:
+        clear_face_enhancer()
+
+
+def enhance_many_frames(many_target_faces: List[List[Face]], temp_frames: List[Frame]) -> List[Frame]:
+    many_affine_matrices = [[cv2.estimateAffinePartial2D(target_face.kps, FFHQ_TEMPLATE, method=cv2.LMEDS)[0] for target_face in target_faces] for target_faces in many_target_faces]
+    crop_frames = [cv2.warpAffine(temp_frame, affine_matrix, (FFHQ_SIZE, FFHQ_SIZE), borderMode=cv2.BORDER_REPLICATE) for affine_matrices, temp_frame in zip(many_affine_matrices, temp_frames) for affine_matrix in affine_matrices]
+    enhance_frames = iter(roop.processors.frame.core.process_batch(BATCH_QUEUE, BATCH_LOCK, crop_frames, enhance_crops, BATCH_SIZE))
+    result_frames = []
+    with profile_stage('paste-back'):
+        for affine_matrices, temp_frame in zip(many_affine_matrices, temp_frames):
+            if affine_matrices:
+                temp_frame = temp_frame.copy()
+                for affine_matrix in affine_matrices:
+                    paste_back(temp_frame, next(enhance_frames), affine_matrix)
+            result_frames.append(temp_frame)
+    return result_frames
+
+
+def enhance_crops(crop_frames: List[Frame]) -> List[Frame]:
+    face_enhancer = get_face_enhancer()
+    crop_batch = numpy.stack(crop_frames)[:, :, :, ::-1].transpose(0, 3, 1, 2).astype(numpy.float32) / 127.5 - 1
+    # the copy back to the cpu waits for the device, so it belongs to the profiled stage
+    with torch.no_grad(), profile_stage('enhance'):
+        enhance_batch = face_enhancer.gfpgan(torch.from_numpy(crop_batch).to(face_enhancer.device), return_rgb=False, weight=0.5)[0].clamp(-1, 1).cpu().numpy()
+    enhance_batch = (enhance_batch + 1) * 127.5
+    return list(enhance_batch.round().astype(numpy.uint8).transpose(0, 2, 3, 1)[:, :, :, ::-1])
+
+
+def paste_back(temp_frame: Frame, crop_frame: Frame, affine_matrix: Any) -> None:
+    region, region_matrix = roop.processors.frame.core.get_paste_back_region(temp_frame, crop_frame, cv2.invertAffineTransform(affine_matrix))
+    region_frame = temp_frame[region]
+    if not region_frame.size:
+        return
+    region_size = (region_frame.shape[1], region_frame.shape[0])
+    inverse_crop_frame = cv2.warpAffine(crop_frame, region_matrix, region_size)
+    inverse_mask = cv2.warpAffine(numpy.ones(crop_frame.shape[:2], dtype=numpy.float32), region_matrix, region_size)
+    inverse_mask = cv2.erode(inverse_mask, numpy.ones((2, 2), numpy.uint8))
+    mask_edge = max(int(numpy.sum(inverse_mask) ** 0.5) // 20, 1)
+    mask_center = cv2.erode(inverse_mask, numpy.ones((mask_edge * 2, mask_edge * 2), numpy.uint8))
+    soft_mask = cv2.GaussianBlur(mask_center, (mask_edge * 2 + 1, mask_edge * 2 + 1), 0)[:, :, None]
+    region_frame = soft_mask * inverse_mask[:, :, None] * inverse_crop_frame + (1 - soft_mask) * region_frame
+    temp_frame[region] = region_frame.clip(0, 255).astype(numpy.uint8)
 
 
 def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
-    many_faces = get_many_faces(temp_frame)
-    if many_faces:
-        for target_face in many_faces:
-            temp_frame = enhance_face(target_face, temp_frame)
-    return temp_frame
+    return process_frame_batch(source_face, reference_face, [temp_frame])[0]
+
+
+def process_frame_batch(source_face: Face, reference_face: Face, temp_frames: List[Frame]) -> List[Frame]:
+    many_target_faces = [get_many_faces(temp_frame) or [] for temp_frame in temp_frames]
+    return enhance_many_frames(many_target_faces, temp_frames)
 
 
 def process_frames(source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(None, None, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    with track_faces():
+        result_frames = process_frame_batch(None, None, temp_frames)
+    for temp_frame_path, result in zip(temp_frame_paths, result_frames):
+        write_temp_frame(temp_frame_path, result)
         if update:
             update()
 
@@ -1,19 +1,27 @@
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional, Tuple
+from queue import Queue
 import cv2
 import insightface
+import numpy
 import threading
+from insightface.utils import face_align
 
 import roop.globals
 import roop.processors.frame.core
 from roop.core import update_status
-from roop.face_analyser import get_one_face, get_many_faces, find_similar_face
+from roop.face_analyser import get_one_face, get_many_faces, get_source_face, find_similar_face, set_faces_cache, track_faces
 from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
+from roop.profiler import profile_stage
 from roop.typing import Face, Frame
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, read_temp_frame, write_temp_frame
 
 FACE_SWAPPER = None
 THREAD_LOCK = threading.Lock()
+BATCH_QUEUE: Queue[Any] = Queue()
+BATCH_LOCK = threading.Lock()
+BATCH_SIZE = 32
 NAME = 'ROOP.FACE-SWAPPER'
+FACE_ANALYSER_MODULES = ['detection', 'recognition']
 
 
 def get_face_swapper() -> Any:
@@ -42,7 +50,7 @@ def pre_start() -> bool:
     if not is_image(roop.globals.source_path):
         update_status('Select an image for source path.', NAME)
         return False
-    elif not get_one_face(cv2.imread(roop.globals.source_path)):
+    elif not get_source_face(roop.globals.source_path):
         update_status('No face in source path detected.', NAME)
         return False
     if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
@@ -52,40 +60,118 @@ def pre_start() -> bool:
 
 
 def post_process() -> None:
-    clear_face_swapper()
+    if not roop.globals.keep_models:
+        clear_face_swapper()
     clear_face_reference()
 
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+def swap_many_frames(source_face: Face, many_target_faces: List[List[Face]], temp_frames: List[Frame]) -> List[Frame]:
+    face_swapper = get_face_swapper()
+    many_crop_items = [[face_align.norm_crop2(temp_frame, target_face.kps, face_swapper.input_size[0]) for target_face in target_faces] for target_faces, temp_frame in zip(many_target_faces, temp_frames)]
+    swap_items = [(source_face, crop_frame) for crop_items in many_crop_items for crop_frame, _ in crop_items]
+    if get_swap_batch_size() == 1:
+        # a model exported with a batch size of one gains nothing from the queue, the execution threads run it side by side instead
+        swap_frames = iter(swap_crops(swap_items) if swap_items else [])
+    else:
+        swap_frames = iter(roop.processors.frame.core.process_batch(BATCH_QUEUE, BATCH_LOCK, swap_items, swap_crops, BATCH_SIZE))
+    result_frames = []
+    with profile_stage('paste-back'):
+        for crop_items, temp_frame in zip(many_crop_items, temp_frames):
+            if crop_items:
+                # all faces are composited into one copy of the frame, each only within its own region
+                temp_frame = temp_frame.copy()
+                for crop_frame, affine_matrix in crop_items:
+                    paste_back(temp_frame, crop_frame, next(swap_frames), affine_matrix)
+            result_frames.append(temp_frame)
+    return result_frames
+
+
+def swap_crops(swap_items: List[Tuple[Face, Frame]]) -> List[Frame]:
+    face_swapper = get_face_swapper()
+    crop_blob = cv2.dnn.blobFromImages([crop_frame for _, crop_frame in swap_items], 1.0 / face_swapper.input_std, face_swapper.input_size, (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+    source_latent = numpy.dot(numpy.stack([source_face.normed_embedding for source_face, _ in swap_items]), face_swapper.emap)
+    source_latent /= numpy.linalg.norm(source_latent, axis=1, keepdims=True)
+    # models exported with a fixed batch dimension are run in slices
+    batch_size = get_swap_batch_size() or len(swap_items)
+    predictions = []
+    with profile_stage('swap'):
+        for index in range(0, len(swap_items), batch_size):
+            predictions.append(face_swapper.session.run(face_swapper.output_names, {
+                face_swapper.input_names[0]: crop_blob[index:index + batch_size],
+                face_swapper.input_names[1]: source_latent[index:index + batch_size]
+            })[0])
+    prediction = numpy.concatenate(predictions).transpose((0, 2, 3, 1))
+    return list(numpy.clip(255 * prediction, 0, 255).astype(numpy.uint8)[:, :, :, ::-1])
+
+
+def get_swap_batch_size() -> Optional[int]:
+    batch_size = get_face_swapper().session.get_inputs()[0].shape[0]
+    if isinstance(batch_size, int) and batch_size > 0:
+        return batch_size
+    return None
+
+
+def paste_back(temp_frame: Frame, crop_frame: Frame, swap_frame: Frame, affine_matrix: Any) -> None:
+    region, region_matrix = roop.processors.frame.core.get_paste_back_region(temp_frame, crop_frame, cv2.invertAffineTransform(affine_matrix))
+    region_frame = temp_frame[region]
+    if not region_frame.size:
+        return
+    region_size = (region_frame.shape[1], region_frame.shape[0])
+    crop_mask = numpy.full(crop_frame.shape[:2], 255, dtype=numpy.float32)
+    swap_frame = cv2.warpAffine(swap_frame, region_matrix, region_size, borderValue=0.0)
+    crop_mask = cv2.warpAffine(crop_mask, region_matrix, region_size, borderValue=0.0)
+    crop_mask[crop_mask > 20] = 255
+    mask_h_indices, mask_w_indices = numpy.where(crop_mask == 255)
+    if not mask_h_indices.size:
+        return
+    mask_size = int(numpy.sqrt((numpy.max(mask_h_indices) - numpy.min(mask_h_indices)) * (numpy.max(mask_w_indices) - numpy.min(mask_w_indices))))
+    erode_size = max(mask_size // 10, 10)
+    crop_mask = cv2.erode(crop_mask, numpy.ones((erode_size, erode_size), numpy.uint8), iterations=1)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    crop_mask = cv2.GaussianBlur(crop_mask, (blur_size, blur_size), 0)
+    crop_mask = numpy.reshape(crop_mask / 255, [crop_mask.shape[0], crop_mask.shape[1], 1])
+    temp_frame[region] = (crop_mask * swap_frame + (1 - crop_mask) * region_frame.astype(numpy.float32)).astype(numpy.uint8)
 
 
 def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
-    if roop.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
+    return process_frame_batch(source_face, reference_face, [temp_frame])[0]
+
+
+def process_frame_batch(source_face: Face, reference_face: Face, temp_frames: List[Frame]) -> List[Frame]:
+    many_faces_list = [get_many_faces(temp_frame) for temp_frame in temp_frames]
+    many_target_faces = []
+    for temp_frame, many_faces in zip(temp_frames, many_faces_list):
+        target_faces = []
+        if roop.globals.many_faces:
+            if many_faces:
+                target_faces = many_faces
+        else:
+            target_face = find_similar_face(temp_frame, reference_face)
+            if target_face:
+                target_faces = [target_face]
+        many_target_faces.append(target_faces)
+    result_frames = swap_many_frames(source_face, many_target_faces, temp_frames)
+    # swapped faces keep their boxes, following processors skip the detection
+    for result_frame, many_faces in zip(result_frames, many_faces_list):
         if many_faces:
-            for target_face in many_faces:
-                temp_frame = swap_face(source_face, target_face, temp_frame)
-    else:
-        target_face = find_similar_face(temp_frame, reference_face)
-        if target_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
-    return temp_frame
+            set_faces_cache(result_frame, many_faces)
+    return result_frames
 
 
 def process_frames(source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
+    source_face = get_source_face(source_path)
     reference_face = None if roop.globals.many_faces else get_face_reference()
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(source_face, reference_face, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    with track_faces():
+        result_frames = process_frame_batch(source_face, reference_face, temp_frames)
+    for temp_frame_path, result in zip(temp_frame_paths, result_frames):
+        write_temp_frame(temp_frame_path, result)
         if update:
             update()
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
+    source_face = get_source_face(source_path)
     target_frame = cv2.imread(target_path)
     reference_face = None if roop.globals.many_faces else get_one_face(target_frame, roop.globals.reference_face_position)
     result = process_frame(source_face, reference_face, target_frame)
@@ -94,7 +180,7 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
     if not roop.globals.many_faces and not get_face_reference():
-        reference_frame = cv2.imread(temp_frame_paths[roop.globals.reference_frame_number])
+        reference_frame = read_temp_frame(temp_frame_paths[roop.globals.reference_frame_number])
         reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
         set_face_reference(reference_face)
     roop.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames)
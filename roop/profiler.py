@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+import psutil
+
+import roop.globals
+
+PROFILE_STAGES: Dict[str, Dict[str, float]] = {}
+PROFILE_THREADS: Dict[str, float] = {}
+PROFILE_DEPTH = threading.local()
+PROFILE_START = time.perf_counter()
+PROFILE_PEAK_MEMORY = 0
+THREAD_LOCK = threading.Lock()
+
+
+@contextmanager
+def profile_stage(stage: str) -> Iterator[None]:
+    if not roop.globals.profile_path:
+        yield
+        return
+    profile_depth = getattr(PROFILE_DEPTH, 'value', 0)
+    PROFILE_DEPTH.value = profile_depth + 1
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILE_DEPTH.value = profile_depth
+        # nested stages are already covered by their outer stage when measuring the thread utilization
+        record_stage(stage, time.perf_counter() - start_time, profile_depth == 0)
+
+
+def record_stage(stage: str, stage_time: float, is_outer_stage: bool) -> None:
+    global PROFILE_PEAK_MEMORY
+
+    memory_usage = psutil.Process(os.getpid()).memory_info().rss if is_outer_stage else 0
+    thread_name = threading.current_thread().name
+    with THREAD_LOCK:
+        profile_stage = PROFILE_STAGES.setdefault(stage, {'calls': 0, 'time': 0.0})
+        profile_stage['calls'] += 1
+        profile_stage['time'] += stage_time
+        if is_outer_stage:
+            PROFILE_THREADS[thread_name] = PROFILE_THREADS.get(thread_name, 0.0) + stage_time
+        PROFILE_PEAK_MEMORY = max(PROFILE_PEAK_MEMORY, memory_usage)
+
+
+def start_profile() -> None:
+    global PROFILE_START, PROFILE_PEAK_MEMORY
+
+    with THREAD_LOCK:
+        PROFILE_STAGES.clear()
+        PROFILE_THREADS.clear()
+        PROFILE_START = time.perf_counter()
+        PROFILE_PEAK_MEMORY = 0
+
+
+def get_profile_report() -> Dict[str, Any]:
+    wall_time = time.perf_counter() - PROFILE_START
+    with THREAD_LOCK:
+        return {
+            'wall_time': wall_time,
+            'peak_memory': PROFILE_PEAK_MEMORY,
+            'execution_providers': roop.globals.execution_providers,
+            'execution_threads': roop.globals.execution_threads,
+            'stages': {stage: {'calls': int(profile_stage['calls']), 'time': profile_stage['time'], 'mean_time': profile_stage['time'] / profile_stage['calls']} for stage, profile_stage in PROFILE_STAGES.items()},
+            'threads': {thread_name: {'busy_time': busy_time, 'utilization': busy_time / wall_time} for thread_name, busy_time in PROFILE_THREADS.items()}
+        }
+
+
+def write_profile_report(profile_path: str) -> None:
+    with open(profile_path, 'w') as profile_file:
+        json.dump(get_profile_report(), profile_file, indent=4)
@@ -0,0 +1,120 @@
+import os
+import json
+import signal
+import argparse
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from wsgiref.simple_server import make_server
+import onnxruntime
+
+import roop.globals
+from roop import core
+from roop.face_analyser import clear_face_analyser, get_face_analyser_signature
+from roop.face_reference import clear_face_reference
+from roop.processors.frame.core import get_frame_processors_modules, clear_frame_processors_modules
+from roop.profiler import start_profile, write_profile_report
+
+NAME = 'ROOP.SERVER'
+FACE_ANALYSER_SIGNATURE: Optional[str] = None
+EXECUTION_PROVIDERS: List[str] = []
+RESIDENT_FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+
+
+def parse_args() -> argparse.Namespace:
+    program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('--host', help='host to listen on', dest='host', default='127.0.0.1')
+    program.add_argument('--port', help='port to listen on', dest='port', type=int, default=8000)
+    return program.parse_args()
+
+
+def run() -> None:
+    args = parse_args()
+    # single thread doubles cuda performance - jobs pick their provider later, so it is decided before torch is imported
+    if 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+        os.environ['OMP_NUM_THREADS'] = '1'
+    roop.globals.headless = True
+    roop.globals.keep_models = True
+    if not core.pre_check():
+        return
+    with make_server(args.host, args.port, handle_request) as server:
+        core.update_status(f'Listening on http://{args.host}:{args.port}/jobs...', NAME)
+        server.serve_forever()
+
+
+def handle_request(environ: Dict[str, Any], start_response: Callable[..., Any]) -> List[bytes]:
+    if environ['PATH_INFO'] != '/jobs':
+        return send_response(start_response, '404 Not Found', {'error': 'Use /jobs to submit a job.'})
+    if environ['REQUEST_METHOD'] != 'POST':
+        return send_response(start_response, '405 Method Not Allowed', {'error': 'Use POST to submit a job.'})
+    try:
+        job_args = json.loads(environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0)))['args']
+        if not isinstance(job_args, list) or not all(isinstance(job_arg, str) for job_arg in job_args):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return send_response(start_response, '400 Bad Request', {'error': 'Send the job as {"args": [...]} using the command line options.'})
+    return send_response(start_response, *run_job(job_args))
+
+
+def send_response(start_response: Callable[..., Any], status: str, body: Dict[str, Any]) -> List[bytes]:
+    response_body = json.dumps(body).encode()
+    start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(response_body)))])
+    return [response_body]
+
+
+def run_job(job_args: List[str]) -> Tuple[str, Dict[str, Any]]:
+    clear_frame_processors_modules()
+    try:
+        core.parse_args(job_args)
+    except SystemExit:
+        return '400 Bad Request', {'error': 'Invalid command line options.'}
+    finally:
+        # parse_args installs the cli handler, but an interrupt has to stop the server rather than exit a job
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    if not roop.globals.headless:
+        roop.globals.headless = True
+        return '400 Bad Request', {'error': 'Select a source, target and output.'}
+    # batches are resolved before they run, the jobs overwrite the paths in the globals
+    is_batch = core.is_batch()
+    try:
+        output_paths = [output_path for _, _, output_path in core.get_batch_jobs()] if is_batch else [roop.globals.output_path]
+    except (OSError, ValueError, KeyError, TypeError):
+        return '400 Bad Request', {'error': 'Invalid batch manifest.'}
+    output_mtimes = [os.path.getmtime(output_path) if os.path.isfile(output_path) else None for output_path in output_paths]
+    prepare_models()
+    try:
+        if all(frame_processor.pre_check() for frame_processor in get_frame_processors_modules(roop.globals.frame_processors)):
+            start_profile()
+            if is_batch:
+                core.start_batch()
+            else:
+                core.start()
+            if roop.globals.profile_path:
+                write_profile_report(roop.globals.profile_path)
+    except SystemExit:
+        pass
+    done_output_paths = [output_path for output_path, output_mtime in zip(output_paths, output_mtimes) if os.path.isfile(output_path) and os.path.getmtime(output_path) != output_mtime]
+    status = 'succeed' if output_paths and len(done_output_paths) == len(output_paths) else 'failed'
+    if is_batch:
+        return '200 OK', {'status': status, 'output_paths': done_output_paths}
+    return '200 OK', {'status': status, 'output_path': output_paths[0]}
+
+
+def prepare_models() -> None:
+    global FACE_ANALYSER_SIGNATURE, EXECUTION_PROVIDERS
+
+    if FACE_ANALYSER_SIGNATURE != get_face_analyser_signature():
+        clear_face_analyser()
+        FACE_ANALYSER_SIGNATURE = get_face_analyser_signature()
+    if EXECUTION_PROVIDERS != roop.globals.execution_providers:
+        clear_face_analyser()
+        roop.globals.keep_models = False
+        for frame_processor in RESIDENT_FRAME_PROCESSORS_MODULES:
+            frame_processor.post_process()
+        roop.globals.keep_models = True
+        RESIDENT_FRAME_PROCESSORS_MODULES.clear()
+        EXECUTION_PROVIDERS = roop.globals.execution_providers
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        if frame_processor not in RESIDENT_FRAME_PROCESSORS_MODULES:
+            RESIDENT_FRAME_PROCESSORS_MODULES.append(frame_processor)
+    # a job that failed half way must not leak its reference face into the next one
+    clear_face_reference()
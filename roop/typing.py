@@ -1,7 +1,9 @@
-from typing import Any
+from typing import Any, TYPE_CHECKING
 
-from insightface.app.common import Face
 import numpy
 
-Face = Face
+if TYPE_CHECKING:
+    from insightface.app.common import Face
+else:
+    Face = Any
 Frame = numpy.ndarray[Any, Any]
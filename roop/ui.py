@@ -1,19 +1,23 @@
 import os
 import sys
+import threading
 import webbrowser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import customtkinter as ctk
 from tkinterdnd2 import TkinterDnD, DND_ALL
-from typing import Any, Callable, Tuple, Optional
+from typing import Any, Callable, Dict, Tuple, Optional
 import cv2
 from PIL import Image, ImageOps
 
 import roop.globals
 import roop.metadata
-from roop.face_analyser import get_one_face
-from roop.capturer import get_video_frame, get_video_frame_total
+from roop.face_analyser import get_one_face, get_source_face
+from roop.capturer import get_video_frame, get_video_frame_total, clear_video_captures
 from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
 from roop.predictor import predict_frame, clear_predictor
 from roop.processors.frame.core import get_frame_processors_modules
+from roop.typing import Frame
 from roop.utilities import is_image, is_video, resolve_relative_path
 
 ROOT = None
@@ -23,6 +27,19 @@ ROOT_WIDTH = 600
 PREVIEW = None
 PREVIEW_MAX_HEIGHT = 700
 PREVIEW_MAX_WIDTH = 1200
+PREVIEW_DEBOUNCE_DELAY = 100
+PREVIEW_POLL_INTERVAL = 20
+PREVIEW_FRAMES: 'OrderedDict[Tuple[Any, ...], Frame]' = OrderedDict()
+PREVIEW_FRAMES_LIMIT = 8
+PREVIEW_IMAGES: 'OrderedDict[Tuple[Any, ...], Image.Image]' = OrderedDict()
+PREVIEW_IMAGES_LIMIT = 64
+PREVIEW_EXECUTOR = None
+PREVIEW_REQUEST = None
+PREVIEW_RESULT = None
+PREVIEW_REFERENCE_KEY = None
+PREVIEW_DEBOUNCE_ID = None
+PREVIEW_POLLING = False
+PREVIEW_LOCK = threading.Lock()
 
 RECENT_DIRECTORY_SOURCE = None
 RECENT_DIRECTORY_TARGET = None
@@ -149,6 +166,7 @@ def select_source_path(source_path: Optional[str] = None) -> None:
 
     if PREVIEW:
         PREVIEW.withdraw()
+        stop_preview()
     if source_path is None:
         source_path = ctk.filedialog.askopenfilename(title='select an source image', initialdir=RECENT_DIRECTORY_SOURCE)
     if is_image(source_path):
@@ -166,6 +184,7 @@ def select_target_path(target_path: Optional[str] = None) -> None:
 
     if PREVIEW:
         PREVIEW.withdraw()
+        stop_preview()
     clear_face_reference()
     if target_path is None:
         target_path = ctk.filedialog.askopenfilename(title='select an target image or video', initialdir=RECENT_DIRECTORY_TARGET)
@@ -207,17 +226,33 @@ def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage
 
 
 def render_video_preview(video_path: str, size: Tuple[int, int], frame_number: int = 0) -> ctk.CTkImage:
-    capture = cv2.VideoCapture(video_path)
-    if frame_number:
-        capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    has_frame, frame = capture.read()
-    if has_frame:
+    frame = read_preview_frame(video_path, frame_number)
+    if frame is not None:
         image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
         if size:
             image = ImageOps.fit(image, size, Image.LANCZOS)
         return ctk.CTkImage(image, size=image.size)
-    capture.release()
-    cv2.destroyAllWindows()
+    return None
+
+
+def read_preview_frame(video_path: str, frame_number: int = 0) -> Optional[Frame]:
+    frame_key = (video_path, frame_number)
+    with PREVIEW_LOCK:
+        if frame_key in PREVIEW_FRAMES:
+            PREVIEW_FRAMES.move_to_end(frame_key)
+            return PREVIEW_FRAMES[frame_key]
+    frame = get_video_frame(video_path, frame_number)
+    if frame is not None:
+        set_preview_cache(PREVIEW_FRAMES, frame_key, frame, PREVIEW_FRAMES_LIMIT)
+    return frame
+
+
+def set_preview_cache(preview_cache: 'OrderedDict[Tuple[Any, ...], Any]', preview_key: Tuple[Any, ...], preview_value: Any, preview_cache_limit: int) -> None:
+    with PREVIEW_LOCK:
+        preview_cache[preview_key] = preview_value
+        preview_cache.move_to_end(preview_key)
+        while len(preview_cache) > preview_cache_limit:
+            preview_cache.popitem(last=False)
 
 
 def toggle_preview() -> None:
@@ -225,7 +260,9 @@ def toggle_preview() -> None:
         PREVIEW.unbind('<Right>')
         PREVIEW.unbind('<Left>')
         PREVIEW.withdraw()
+        stop_preview()
         clear_predictor()
+        clear_video_captures()
     elif roop.globals.source_path and roop.globals.target_path:
         init_preview()
         update_preview(roop.globals.reference_frame_number)
@@ -248,17 +285,88 @@ def init_preview() -> None:
 
 
 def update_preview(frame_number: int = 0) -> None:
+    global PREVIEW_DEBOUNCE_ID
+
     if roop.globals.source_path and roop.globals.target_path:
-        temp_frame = get_video_frame(roop.globals.target_path, frame_number)
+        if PREVIEW_DEBOUNCE_ID:
+            PREVIEW.after_cancel(PREVIEW_DEBOUNCE_ID)
+            PREVIEW_DEBOUNCE_ID = None
+        preview_key = get_preview_key(int(frame_number))
+        with PREVIEW_LOCK:
+            image = PREVIEW_IMAGES.get(preview_key)
+        if image:
+            request_preview(preview_key)
+            show_preview(image)
+        else:
+            # the slider fires for every step, only the frame it rests on gets rendered
+            PREVIEW_DEBOUNCE_ID = PREVIEW.after(PREVIEW_DEBOUNCE_DELAY, lambda: request_preview(preview_key))
+
+
+def get_preview_key(frame_number: int) -> Tuple[Any, ...]:
+    return (
+        roop.globals.source_path,
+        roop.globals.target_path,
+        frame_number,
+        tuple(roop.globals.frame_processors),
+        roop.globals.many_faces,
+        roop.globals.reference_face_position,
+        roop.globals.reference_frame_number,
+        roop.globals.similar_face_distance
+    )
+
+
+def request_preview(preview_key: Tuple[Any, ...]) -> None:
+    global PREVIEW_EXECUTOR, PREVIEW_REQUEST, PREVIEW_DEBOUNCE_ID, PREVIEW_POLLING
+
+    PREVIEW_DEBOUNCE_ID = None
+    with PREVIEW_LOCK:
+        # a cached image resolves the request right away, renders still in flight are overtaken
+        if preview_key in PREVIEW_IMAGES:
+            PREVIEW_REQUEST = None
+            return
+        PREVIEW_REQUEST = preview_key
+    if PREVIEW_EXECUTOR is None:
+        PREVIEW_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    PREVIEW_EXECUTOR.submit(render_preview, preview_key)
+    # a single poll loop serves every request, it ends once the current one is resolved
+    if not PREVIEW_POLLING:
+        PREVIEW_POLLING = True
+        PREVIEW.after(PREVIEW_POLL_INTERVAL, poll_preview)
+
+
+def stop_preview() -> None:
+    global PREVIEW_REQUEST, PREVIEW_DEBOUNCE_ID
+
+    if PREVIEW_DEBOUNCE_ID:
+        PREVIEW.after_cancel(PREVIEW_DEBOUNCE_ID)
+        PREVIEW_DEBOUNCE_ID = None
+    # pending renders are skipped and the poll loop ends on its next tick
+    with PREVIEW_LOCK:
+        PREVIEW_REQUEST = None
+
+
+def render_preview(preview_key: Tuple[Any, ...]) -> None:
+    global PREVIEW_RESULT, PREVIEW_REFERENCE_KEY
+
+    source_path, target_path, frame_number, _, _, reference_face_position, reference_frame_number, _ = preview_key
+    preview_result: Dict[str, Any] = {'key': preview_key, 'image': None, 'nsfw': False}
+    try:
+        # requests that were overtaken while waiting in the queue are skipped
+        with PREVIEW_LOCK:
+            if preview_key != PREVIEW_REQUEST:
+                return
+        temp_frame = read_preview_frame(target_path, frame_number)
         if predict_frame(temp_frame):
-            sys.exit()
-        source_face = get_one_face(cv2.imread(roop.globals.source_path))
-        if not get_face_reference():
-            reference_frame = get_video_frame(roop.globals.target_path, roop.globals.reference_frame_number)
-            reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
+            preview_result['nsfw'] = True
+            return
+        source_face = get_source_face(source_path)
+        reference_face = get_face_reference()
+        # the reference is taken from the request, the window may have moved on to another one meanwhile
+        if not reference_face or PREVIEW_REFERENCE_KEY != (target_path, reference_frame_number, reference_face_position):
+            reference_frame = read_preview_frame(target_path, reference_frame_number)
+            reference_face = get_one_face(reference_frame, reference_face_position)
             set_face_reference(reference_face)
-        else:
-            reference_face = get_face_reference()
+            PREVIEW_REFERENCE_KEY = (target_path, reference_frame_number, reference_face_position)
         for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
             temp_frame = frame_processor.process_frame(
                 source_face,
@@ -267,8 +375,37 @@ def update_preview(frame_number: int = 0) -> None:
             )
         image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
         image = ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
-        image = ctk.CTkImage(image, size=image.size)
-        preview_label.configure(image=image)
+        set_preview_cache(PREVIEW_IMAGES, preview_key, image, PREVIEW_IMAGES_LIMIT)
+        preview_result['image'] = image
+    finally:
+        with PREVIEW_LOCK:
+            PREVIEW_RESULT = preview_result
+
+
+def poll_preview() -> None:
+    global PREVIEW_RESULT, PREVIEW_POLLING
+
+    with PREVIEW_LOCK:
+        preview_result = PREVIEW_RESULT
+        preview_request = PREVIEW_REQUEST
+        if preview_result and preview_result['key'] == preview_request:
+            PREVIEW_RESULT = None
+    if preview_request is None:
+        PREVIEW_POLLING = False
+        return
+    # tk is not thread safe, the window picks up the result of the worker itself
+    if not preview_result or preview_result['key'] != preview_request:
+        PREVIEW.after(PREVIEW_POLL_INTERVAL, poll_preview)
+        return
+    PREVIEW_POLLING = False
+    if preview_result['nsfw']:
+        sys.exit()
+    if preview_result['image']:
+        show_preview(preview_result['image'])
+
+
+def show_preview(image: Image.Image) -> None:
+    preview_label.configure(image=ctk.CTkImage(image, size=image.size))
 
 
 def update_face_reference(steps: int) -> None:
@@ -1,19 +1,38 @@
 import glob
+import json
+import math
 import mimetypes
 import os
 import platform
 import shutil
 import ssl
 import subprocess
+import threading
 import urllib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+import cv2
+import numpy
 from tqdm import tqdm
 
 import roop.globals
+from roop.capturer import get_video_frame_total
+from roop.profiler import profile_stage
+from roop.typing import Frame
 
 TEMP_DIRECTORY = 'temp'
 TEMP_VIDEO_FILE = 'temp.mp4'
+TEMP_FRAME_STORE_FILE = 'frames.raw'
+TEMP_FRAME_INDEX_FILE = 'frames.json'
+TEMP_REFERENCE_FRAME_FILE = 'reference.png'
+TEMP_SEGMENT_DIRECTORY = 'segments'
+TEMP_SEGMENT_LIST_FILE = 'segments.txt'
+EXTRACT_RANGE_DURATION = 30
+EXTRACT_SEEK_MARGIN = 1
+TEMP_FRAME_STORES: Dict[str, Any] = {}
+TEMP_FRAME_STORES_LOCK = threading.Lock()
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
@@ -31,9 +50,16 @@ def run_ffmpeg(args: List[str]) -> bool:
     return False
 
 
+def open_ffmpeg(args: List[str], **kwargs: Any) -> 'subprocess.Popen[bytes]':
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level]
+    commands.extend(args)
+    return subprocess.Popen(commands, **kwargs)
+
+
 def detect_fps(target_path: str) -> float:
     command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
-    output = subprocess.check_output(command).decode().strip().split('/')
+    with profile_stage('probe'):
+        output = subprocess.check_output(command).decode().strip().split('/')
     try:
         numerator, denominator = map(int, output)
         return numerator / denominator
@@ -42,35 +68,227 @@ def detect_fps(target_path: str) -> float:
     return 30
 
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation', '-of', 'json', target_path]
+    with profile_stage('probe'):
+        stream = json.loads(subprocess.check_output(command))['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    rotation = int(stream.get('tags', {}).get('rotate', 0))
+    for side_data in stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+    # ffmpeg applies the rotation while decoding
+    if abs(rotation) % 180 == 90:
+        return height, width
+    return width, height
+
+
 def extract_frames(target_path: str, fps: float = 30) -> bool:
+    if roop.globals.temp_frame_format == 'raw':
+        return extract_raw_frames(target_path, fps)
+    extract_ranges = get_extract_ranges(target_path, fps)
+    with profile_stage('extract'):
+        with ThreadPoolExecutor(max_workers=len(extract_ranges)) as executor:
+            return all(executor.map(lambda extract_range: extract_frame_range(target_path, fps, *extract_range), extract_ranges))
+
+
+def get_extract_ranges(target_path: str, fps: float) -> List[Tuple[int, Optional[int]]]:
+    target_duration = get_video_frame_total(target_path) / detect_fps(target_path)
+    # the execution threads are sized for the models, the image encoding of each range takes a cpu core
+    extract_range_total = max(min(os.cpu_count() or 1, int(target_duration // EXTRACT_RANGE_DURATION)), 1)
+    extract_range_frame_total = math.ceil(target_duration * fps / extract_range_total)
+    # the last range runs to the end, the frame total is only an estimate
+    return [(index * extract_range_frame_total, extract_range_frame_total if index < extract_range_total - 1 else None) for index in range(extract_range_total)]
+
+
+def extract_frame_range(target_path: str, fps: float, start_frame: int, frame_total: Optional[int]) -> bool:
     temp_directory_path = get_temp_directory_path(target_path)
     temp_frame_quality = roop.globals.temp_frame_quality * 31 // 100
-    return run_ffmpeg(['-hwaccel', 'auto', '-i', target_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps), os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+    # seeking lands on the keyframe before, a margin of frames ahead makes the rate conversion pick the same frames as a single pass
+    seek_frame = max(start_frame - math.ceil(fps * EXTRACT_SEEK_MARGIN), 0)
+    commands = ['-hwaccel', 'auto', '-ss', str(seek_frame / fps), '-i', target_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps) + ',trim=start_pts=' + str(start_frame - seek_frame)]
+    if frame_total is not None:
+        commands.extend(['-frames:v', str(frame_total)])
+    commands.extend(['-start_number', str(start_frame + 1), os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+    return run_ffmpeg(commands)
 
 
-def create_video(target_path: str, fps: float = 30) -> bool:
-    temp_output_path = get_temp_output_path(target_path)
+def extract_raw_frames(target_path: str, fps: float = 30) -> bool:
     temp_directory_path = get_temp_directory_path(target_path)
+    temp_frame_store_path = os.path.join(temp_directory_path, TEMP_FRAME_STORE_FILE)
+    width, height = detect_resolution(target_path)
+    with profile_stage('extract'):
+        if not run_ffmpeg(['-hwaccel', 'auto', '-i', target_path, '-vf', 'fps=' + str(fps), '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-y', temp_frame_store_path]):
+            return False
+    temp_frame_total = os.path.getsize(temp_frame_store_path) // (width * height * 3)
+    with open(os.path.join(temp_directory_path, TEMP_FRAME_INDEX_FILE), 'w') as temp_frame_index_file:
+        json.dump({'width': width, 'height': height, 'total': temp_frame_total}, temp_frame_index_file)
+    return True
+
+
+def extract_segment_frames(reader: 'subprocess.Popen[bytes]', resolution: Tuple[int, int], temp_directory_path: str, temp_frame_total: int) -> int:
+    Path(temp_directory_path).mkdir(parents=True, exist_ok=True)
+    temp_frame_number = 0
+    with profile_stage('extract'):
+        # raw frames come out of the reader as they are stored, the store is written in one go
+        with open(os.path.join(temp_directory_path, TEMP_FRAME_STORE_FILE), 'wb') if roop.globals.temp_frame_format == 'raw' else nullcontext() as temp_frame_store_file:
+            while temp_frame_number < temp_frame_total:
+                temp_frame = read_frame(reader, resolution)
+                if temp_frame is None:
+                    break
+                temp_frame_number += 1
+                if temp_frame_store_file:
+                    temp_frame_store_file.write(temp_frame.data)
+                else:
+                    cv2.imwrite(os.path.join(temp_directory_path, str(temp_frame_number).zfill(4) + '.' + roop.globals.temp_frame_format), temp_frame, [cv2.IMWRITE_JPEG_QUALITY, 100 - roop.globals.temp_frame_quality])
+    if roop.globals.temp_frame_format == 'raw':
+        width, height = resolution
+        with open(os.path.join(temp_directory_path, TEMP_FRAME_INDEX_FILE), 'w') as temp_frame_index_file:
+            json.dump({'width': width, 'height': height, 'total': temp_frame_number}, temp_frame_index_file)
+    return temp_frame_number
+
+
+def skip_segment_frames(reader: 'subprocess.Popen[bytes]', resolution: Tuple[int, int], temp_frame_total: int) -> int:
+    temp_frame_number = 0
+    while temp_frame_number < temp_frame_total and read_frame(reader, resolution) is not None:
+        temp_frame_number += 1
+    return temp_frame_number
+
+
+def create_video(target_path: str, fps: float = 30) -> bool:
+    return encode_temp_frames(get_temp_directory_path(target_path), get_temp_output_path(target_path), fps)
+
+
+def encode_temp_frames(temp_directory_path: str, temp_output_path: str, fps: float = 30) -> bool:
+    if roop.globals.temp_frame_format == 'raw':
+        release_temp_frame_store(temp_directory_path)
+        temp_frame_index = load_temp_frame_index(temp_directory_path)
+        commands = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', str(temp_frame_index['width']) + 'x' + str(temp_frame_index['height']), '-r', str(fps), '-i', os.path.join(temp_directory_path, TEMP_FRAME_STORE_FILE)]
+    else:
+        commands = ['-hwaccel', 'auto', '-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)]
+    commands.extend(get_output_video_args())
+    commands.extend(['-y', temp_output_path])
+    with profile_stage('encode'):
+        return run_ffmpeg(commands)
+
+
+def concat_segment_videos(target_path: str, segment_video_paths: List[str]) -> bool:
+    temp_segment_list_path = os.path.join(get_temp_directory_path(target_path), TEMP_SEGMENT_LIST_FILE)
+    with open(temp_segment_list_path, 'w') as temp_segment_list_file:
+        for segment_video_path in segment_video_paths:
+            temp_segment_list_file.write("file '" + os.path.abspath(segment_video_path).replace("'", "'\\''") + "'\n")
+    with profile_stage('concat'):
+        return run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', temp_segment_list_path, '-c', 'copy', '-y', get_temp_output_path(target_path)])
+
+
+def get_output_video_args() -> List[str]:
     output_video_quality = (roop.globals.output_video_quality + 1) * 51 // 100
-    commands = ['-hwaccel', 'auto', '-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format), '-c:v', roop.globals.output_video_encoder]
+    commands = ['-c:v', roop.globals.output_video_encoder]
     if roop.globals.output_video_encoder in ['libx264', 'libx265', 'libvpx']:
         commands.extend(['-crf', str(output_video_quality)])
     if roop.globals.output_video_encoder in ['h264_nvenc', 'hevc_nvenc']:
         commands.extend(['-cq', str(output_video_quality)])
-    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
-    return run_ffmpeg(commands)
+    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1'])
+    return commands
+
+
+def open_frame_reader(target_path: str, fps: float = 30) -> 'subprocess.Popen[bytes]':
+    return open_ffmpeg(['-hwaccel', 'auto', '-i', target_path, '-vf', 'fps=' + str(fps), '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=subprocess.PIPE)
+
+
+def open_frame_writer(target_path: str, resolution: Tuple[int, int], fps: float = 30) -> 'subprocess.Popen[bytes]':
+    temp_output_path = get_temp_output_path(target_path)
+    width, height = resolution
+    commands = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', str(width) + 'x' + str(height), '-r', str(fps), '-i', '-']
+    commands.extend(get_output_video_args())
+    commands.extend(['-y', temp_output_path])
+    return open_ffmpeg(commands, stdin=subprocess.PIPE)
+
+
+def read_frame(process: 'subprocess.Popen[bytes]', resolution: Tuple[int, int]) -> Optional[Frame]:
+    width, height = resolution
+    with profile_stage('decode'):
+        buffer = process.stdout.read(width * height * 3)
+    if len(buffer) == width * height * 3:
+        return numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, width, 3).copy()
+    return None
+
+
+def write_frame(process: 'subprocess.Popen[bytes]', frame: Frame) -> None:
+    with profile_stage('encode'):
+        process.stdin.write(numpy.ascontiguousarray(frame).data)
 
 
 def restore_audio(target_path: str, output_path: str) -> None:
     temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
+    with profile_stage('audio'):
+        done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
     if not done:
         move_temp(target_path, output_path)
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
-    temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format)))
+    return find_temp_frame_paths(get_temp_directory_path(target_path))
+
+
+def find_temp_frame_paths(temp_directory_path: str) -> List[str]:
+    # raw frames live in a single store, their paths only address a slot in it
+    if roop.globals.temp_frame_format == 'raw':
+        if not os.path.isfile(os.path.join(temp_directory_path, TEMP_FRAME_INDEX_FILE)):
+            return []
+        temp_frame_total = load_temp_frame_index(temp_directory_path)['total']
+        return [os.path.join(temp_directory_path, str(temp_frame_number).zfill(4) + '.raw') for temp_frame_number in range(1, temp_frame_total + 1)]
+    # frames are numbered, which keeps other files such as the reference frame out of the list
+    temp_frame_paths = glob.glob((os.path.join(glob.escape(temp_directory_path), '[0-9]*.' + roop.globals.temp_frame_format)))
+    return sorted(temp_frame_paths, key=lambda temp_frame_path: int(Path(temp_frame_path).stem))
+
+
+def load_temp_frame_index(temp_directory_path: str) -> Dict[str, int]:
+    with open(os.path.join(temp_directory_path, TEMP_FRAME_INDEX_FILE)) as temp_frame_index_file:
+        return json.load(temp_frame_index_file)
+
+
+def get_temp_frame_store(temp_directory_path: str) -> Any:
+    with TEMP_FRAME_STORES_LOCK:
+        if temp_directory_path not in TEMP_FRAME_STORES:
+            temp_frame_index = load_temp_frame_index(temp_directory_path)
+            temp_frame_shape = (temp_frame_index['total'], temp_frame_index['height'], temp_frame_index['width'], 3)
+            TEMP_FRAME_STORES[temp_directory_path] = numpy.memmap(os.path.join(temp_directory_path, TEMP_FRAME_STORE_FILE), dtype=numpy.uint8, mode='r+', shape=temp_frame_shape)
+    return TEMP_FRAME_STORES[temp_directory_path]
+
+
+def release_temp_frame_store(temp_directory_path: str) -> None:
+    with TEMP_FRAME_STORES_LOCK:
+        temp_frame_store = TEMP_FRAME_STORES.pop(temp_directory_path, None)
+    if temp_frame_store is not None:
+        temp_frame_store.flush()
+
+
+def get_temp_frame_slot(temp_frame_path: str) -> Tuple[Any, int]:
+    return get_temp_frame_store(os.path.dirname(temp_frame_path)), int(Path(temp_frame_path).stem) - 1
+
+
+def read_temp_frame(temp_frame_path: str, flags: int = cv2.IMREAD_COLOR) -> Frame:
+    with profile_stage('decode'):
+        if temp_frame_path.endswith('.raw'):
+            temp_frame_store, temp_frame_index = get_temp_frame_slot(temp_frame_path)
+            return numpy.array(temp_frame_store[temp_frame_index])
+        return cv2.imread(temp_frame_path, flags)
+
+
+def write_temp_frame(temp_frame_path: str, temp_frame: Frame) -> None:
+    with profile_stage('imwrite'):
+        if temp_frame_path.endswith('.raw'):
+            temp_frame_store, temp_frame_index = get_temp_frame_slot(temp_frame_path)
+            temp_frame_store[temp_frame_index] = temp_frame
+        else:
+            cv2.imwrite(temp_frame_path, temp_frame)
+
+
+def copy_temp_frame(source_temp_frame_path: str, target_temp_frame_path: str) -> None:
+    if target_temp_frame_path.endswith('.raw'):
+        write_temp_frame(target_temp_frame_path, read_temp_frame(source_temp_frame_path))
+    else:
+        shutil.copyfile(source_temp_frame_path, target_temp_frame_path)
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -84,10 +302,23 @@ def get_temp_output_path(target_path: str) -> str:
     return os.path.join(temp_directory_path, TEMP_VIDEO_FILE)
 
 
+def get_temp_reference_frame_path(target_path: str) -> str:
+    temp_directory_path = get_temp_directory_path(target_path)
+    return os.path.join(temp_directory_path, TEMP_REFERENCE_FRAME_FILE)
+
+
+def get_temp_segment_paths(target_path: str, segment_number: int) -> Tuple[str, str]:
+    temp_segment_directory_path = os.path.join(get_temp_directory_path(target_path), TEMP_SEGMENT_DIRECTORY, str(segment_number).zfill(4))
+    return temp_segment_directory_path, temp_segment_directory_path + '.mp4'
+
+
 def normalize_output_path(source_path: str, target_path: str, output_path: str) -> Optional[str]:
     if source_path and target_path and output_path:
         source_name, _ = os.path.splitext(os.path.basename(source_path))
         target_name, target_extension = os.path.splitext(os.path.basename(target_path))
+        # batches name their outputs per job
+        if os.path.isdir(source_path) or os.path.isdir(target_path):
+            return output_path
         if os.path.isdir(output_path):
             return os.path.join(output_path, source_name + '-' + target_name + target_extension)
     return output_path
@@ -109,12 +340,19 @@ def move_temp(target_path: str, output_path: str) -> None:
 def clean_temp(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
     parent_directory_path = os.path.dirname(temp_directory_path)
+    release_temp_frame_store(temp_directory_path)
     if not roop.globals.keep_frames and os.path.isdir(temp_directory_path):
         shutil.rmtree(temp_directory_path)
     if os.path.exists(parent_directory_path) and not os.listdir(parent_directory_path):
         os.rmdir(parent_directory_path)
 
 
+def resolve_media_paths(path: str) -> List[str]:
+    if os.path.isdir(path):
+        return [file_path for file_path in sorted(glob.glob(os.path.join(glob.escape(path), '*'))) if is_image(file_path) or is_video(file_path)]
+    return [path]
+
+
 def has_image_extension(image_path: str) -> bool:
     return image_path.lower().endswith(('png', 'jpg', 'jpeg', 'webp'))
 
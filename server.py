@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+from roop import server
+
+if __name__ == '__main__':
+    server.run()